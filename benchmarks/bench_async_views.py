@@ -0,0 +1,113 @@
+"""
+IO密集型view在同步与协程两种写法下的吞吐对比。
+
+每个请求等待三个后端（模拟SPARQL、MySQL、Redis），两种写法做同样形状的工作：
+
+- seq  依次等待三个后端：同步写法time.sleep三次，协程写法await三次
+- par  并发等待三个后端：同步写法交给线程池，协程写法asyncio.gather
+
+所有请求都经过DNApp的view调度（test_client），--threads为同时发请求的线程数，
+对应worker中同时处理的请求数，1即sync worker。
+
+注意：协程view在请求线程中调用aio.run_coroutine，一直阻塞到协程结束，
+协程只能让同一个请求内部的多个等待重叠，不能让多个请求在同一个线程中重叠，
+sync worker中协程写法不会提高请求之间的并发，吞吐仍然取决于worker和线程的数量。
+gevent worker中只阻塞当前的greenlet，多个请求的协程在同一个事件循环中并发等待。
+
+    PYTHONPATH=. python benchmarks/bench_async_views.py --threads 1,16 --seconds 5
+"""
+import argparse
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dn.app import DNApp, DNView
+from dn.common import log
+
+BACKEND_LATENCY = 0.02
+BACKENDS = ('sparql', 'mysql', 'redis')
+
+_backend_pool = ThreadPoolExecutor(64)
+
+
+def backend_sync(name):
+    time.sleep(BACKEND_LATENCY)
+    return name
+
+
+async def backend_async(name):
+    await asyncio.sleep(BACKEND_LATENCY)
+    return name
+
+
+class BenchIOView(DNView):
+    def io_sync_seq(self):
+        result = [backend_sync(name) for name in BACKENDS]
+        return {'data': result, 'n': self._request_data.get('n')}
+
+    def io_sync_par(self):
+        result = list(_backend_pool.map(backend_sync, BACKENDS))
+        return {'data': result, 'n': self._request_data.get('n')}
+
+    async def io_async_seq(self):
+        result = []
+        for name in BACKENDS:
+            result.append(await backend_async(name))
+        return {'data': result, 'n': self._request_data.get('n')}
+
+    async def io_async_par(self):
+        result = await asyncio.gather(*[backend_async(name)
+                                        for name in BACKENDS])
+        return {'data': list(result), 'n': self._request_data.get('n')}
+
+
+def drive(app, path, threads, seconds):
+    count = [0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def worker():
+        client = app.flaskapp.test_client()
+        n = 0
+        while time.time() < deadline:
+            resp = client.post(path, json={'n': n})
+            assert resp.status_code == 200, resp.data
+            n += 1
+        with lock:
+            count[0] += n
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - started
+    return count[0] / elapsed, elapsed * threads / max(count[0], 1) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', default='1,16',
+                        help='逗号分隔的并发线程数')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    log.setup(stdout=False)
+    app = DNApp.register_view_func()
+    print('backend latency %dms x %d' % (BACKEND_LATENCY * 1000,
+                                         len(BACKENDS)))
+    print('%-6s %-6s %8s %12s %10s' % ('shape', 'view', 'threads', 'req/s',
+                                       'ms/req'))
+    for threads in [int(t) for t in args.threads.split(',')]:
+        for shape in ('seq', 'par'):
+            for kind in ('sync', 'async'):
+                rps, latency = drive(app, '/io/%s/%s' % (kind, shape),
+                                     threads, args.seconds)
+                print('%-6s %-6s %8d %12.1f %10.1f' % (
+                    shape, kind, threads, rps, latency))
+
+
+if __name__ == '__main__':
+    main()
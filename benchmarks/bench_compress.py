@@ -0,0 +1,47 @@
+"""
+不同压缩级别下，压缩一个典型json响应的CPU耗时与节省的字节数。
+
+    python benchmarks/bench_compress.py --rows 5000
+"""
+import argparse
+import json
+import time
+
+from dn.common.compress import Compressor
+
+
+def make_payload(n):
+    rows = [{'id': i,
+             'name': 'entity_%d' % i,
+             'type': 'Person' if i % 3 else 'Organization',
+             'relations': [{'p': 'knows', 'o': 'entity_%d' % (i + 1)}],
+             'score': round(i * 0.37, 2)}
+            for i in range(n)]
+    return json.dumps({'code': 0, 'data': rows},
+                      separators=(',', ':')).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    data = make_payload(args.rows)
+    print('payload %d bytes' % len(data))
+    print('%-8s %-5s %10s %10s %8s %10s' % (
+        'encoding', 'level', 'bytes', 'saved', 'ratio', 'ms/resp'))
+    for encoding in ('gzip', 'deflate'):
+        for level in (1, 3, 6, 9):
+            compressor = Compressor(level=level)
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                compressed = compressor.compress(data, encoding)
+            cost = (time.perf_counter() - started) / args.repeat
+            print('%-8s %-5d %10d %10d %7.1fx %10.2f' % (
+                encoding, level, len(compressed), len(data) - len(compressed),
+                len(data) / len(compressed), cost * 1000))
+
+
+if __name__ == '__main__':
+    main()
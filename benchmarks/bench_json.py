@@ -0,0 +1,60 @@
+"""
+对比flask的jsonify与各个序列化backend编码大列表的耗时。
+
+    python benchmarks/bench_json.py --rows 20000 --repeat 20
+"""
+import argparse
+import datetime
+import time
+
+from flask import Flask, jsonify
+
+from dn.common.serializer import BACKENDS, JSONSerializer
+
+
+def make_rows(n):
+    now = datetime.datetime(2019, 6, 1, 12, 0, 0)
+    return [{'id': i,
+             'name': 'entity_%d' % i,
+             'label': '实体%d' % i,
+             'score': i * 0.37,
+             'tags': ['a', 'b', 'c'],
+             'updated_at': now + datetime.timedelta(seconds=i)}
+            for i in range(n)]
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        cost = time.perf_counter() - started
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    app = Flask(__name__)
+    with app.app_context():
+        cost = timeit(lambda: jsonify(rows).get_data(), args.repeat)
+        size = len(jsonify(rows).get_data())
+        print('%-12s %8.2f ms  %d bytes' % ('jsonify', cost * 1000, size))
+
+        for backend in BACKENDS:
+            serializer = JSONSerializer(backend)
+            if serializer.backend != backend:
+                print('%-12s not installed' % backend)
+                continue
+            cost = timeit(lambda: serializer.dumps(rows), args.repeat)
+            size = len(serializer.dumps(rows))
+            print('%-12s %8.2f ms  %d bytes' % (backend, cost * 1000, size))
+
+
+if __name__ == '__main__':
+    main()
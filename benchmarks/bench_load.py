@@ -0,0 +1,397 @@
+"""
+DNApp的压测：几类典型的view在进程内(wsgi)和通过本机HTTP在sync、threads、
+gevent worker下的吞吐量、延迟和内存。
+
+    # 全部组合，结果写入json
+    PYTHONPATH=. python benchmarks/bench_load.py --output before.json
+    # 修改之后再跑一次，与之前的结果对比
+    PYTHONPATH=. python benchmarks/bench_load.py --output after.json --compare before.json
+    # 只跑其中的一部分
+    PYTHONPATH=. python benchmarks/bench_load.py --modes wsgi,gevent --endpoints trivial,io
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from dn.app import DNApp, DNView
+from dn.common import log
+
+MODES = ['wsgi', 'sync', 'threads', 'gevent']
+
+# 名称: (路径, 参数)
+ENDPOINTS = {
+    'trivial': ('/load/trivial', {}),
+    'json': ('/load/json', {'rows': 200}),
+    'io': ('/load/io', {'ms': 10}),
+    'cpu': ('/load/cpu', {'work': 20000}),
+}
+
+
+def burn(n):
+    total = 0
+    for i in range(n):
+        total += i * i % 7
+    return total
+
+
+class BenchLoadView(DNView):
+    def load_trivial(self):
+        return 'ok'
+
+    def load_json(self):
+        rows = int(self._request_data.get('rows', 200))
+        return [{'id': i, 'name': 'item-%d' % i, 'score': i * 0.5,
+                 'tags': ['a', 'b', 'c'], 'attrs': {'x': i, 'y': None}}
+                for i in range(rows)]
+
+    def load_io(self):
+        time.sleep(float(self._request_data.get('ms', 10)) / 1000)
+        return 'ok'
+
+    def load_cpu(self):
+        return {'total': burn(int(self._request_data.get('work', 20000)))}
+
+
+def percentile(latencies, q):
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def _vm_rss(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _children(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            return [int(p) for p in f.read().split()]
+    except (IOError, OSError):
+        return []
+
+
+def rss_mb(pid=None):
+    """pid及其所有子进程的RSS之和，没有/proc时只能取当前进程的峰值。"""
+    if not os.path.exists('/proc/self/status'):
+        # linux上ru_maxrss的单位为KB，macOS上为字节
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return round(maxrss * scale / 1048576.0, 1)
+    pids = [pid or os.getpid()]
+    total = 0
+    while pids:
+        p = pids.pop()
+        try:
+            total += _vm_rss(p)
+        except (IOError, OSError):
+            continue
+        pids.extend(_children(p))
+    return round(total / 1048576.0, 1)
+
+
+def wsgi_requester(flaskapp, path, params):
+    from werkzeug.test import EnvironBuilder
+
+    environ = EnvironBuilder(path, query_string=params).get_environ()
+    status = [None]
+
+    def start_response(s, headers, exc_info=None):
+        status[0] = int(s.split(' ', 1)[0])
+
+    def request():
+        rv = flaskapp.wsgi_app(dict(environ), start_response)
+        try:
+            for _ in rv:
+                pass
+        finally:
+            if hasattr(rv, 'close'):
+                rv.close()
+        return status[0]
+    return request
+
+
+def http_requester(address, path, params):
+    host, port = address
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    url = path + ('?' + urlencode(params) if params else '')
+
+    def request():
+        # sync worker每个响应之后都会关闭连接，HTTPConnection会自动重连
+        try:
+            conn.request('GET', url)
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            return None
+    return request
+
+
+def drive(make_requester, concurrency, seconds, warmup):
+    """concurrency个线程在seconds秒内不停地请求，返回吞吐量和延迟。"""
+    results = []
+    lock = threading.Lock()
+    # 所有线程预热完之后同时开始计时
+    warmed = threading.Barrier(concurrency + 1)
+    start = threading.Event()
+    timing = {}
+
+    def worker():
+        request = make_requester()
+        end = time.time() + warmup
+        while time.time() < end:
+            request()
+        warmed.wait()
+        start.wait()
+        latencies = []
+        errors = 0
+        deadline = timing['deadline']
+        while True:
+            started = time.perf_counter()
+            if started >= deadline:
+                break
+            status = request()
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+        with lock:
+            results.append((latencies, errors))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    warmed.wait()
+    started = time.perf_counter()
+    timing['deadline'] = started + seconds
+    start.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(l for items, _ in results for l in items)
+    errors = sum(e for _, e in results)
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(p50 * 1000, 3) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 3) if p99 is not None else None,
+    }
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_ready(address, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited with %s' % proc.returncode)
+        try:
+            conn = http.client.HTTPConnection(*address, timeout=1)
+            conn.request('GET', '/health/live')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except (http.client.HTTPException, OSError):
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('server not ready in %ss' % timeout)
+
+
+def start_server(worker_class, workers, threads):
+    address = ('127.0.0.1', free_port())
+    cmd = [sys.executable, os.path.abspath(__file__), '--serve',
+           '--bind', '%s:%d' % address, '--worker-class', worker_class,
+           '--workers', str(workers), '--threads', str(threads)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(address, proc)
+    except Exception:
+        stop_server(proc)
+        raise
+    return proc, address
+
+
+def stop_server(proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def serve(args):
+    log.setup(stdout=False)
+    app = DNApp.register_view_func()
+    app.serve(bind=args.bind, worker_class=args.worker_class,
+              workers=args.workers, threads=args.threads)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(item):
+    return (item['mode'], item['endpoint'], item['concurrency'])
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    old = dict((result_key(item), item) for item in baseline['results'])
+
+    def delta(new, before):
+        if not new or not before:
+            return '-'
+        return '%+.1f%%' % ((new - before) * 100.0 / before)
+
+    print()
+    print('compare with %s (commit %s)' % (
+        baseline_file, baseline['meta'].get('commit')))
+    print('%-8s %-8s %12s %12s %10s %10s %10s' % (
+        'mode', 'endpoint', 'old req/s', 'new req/s', 'req/s', 'p99', 'rss'))
+    matched = 0
+    for item in results:
+        before = old.get(result_key(item))
+        if before is None:
+            continue
+        matched += 1
+        print('%-8s %-8s %12.1f %12.1f %10s %10s %10s' % (
+            item['mode'], item['endpoint'], before['rps'], item['rps'],
+            delta(item['rps'], before['rps']),
+            delta(item['p99_ms'], before['p99_ms']),
+            delta(item['rss_mb'], before['rss_mb'])))
+    if not matched:
+        # 模式、endpoint和并发数都相同的结果才能比较
+        print('no comparable cases, check --modes/--endpoints/--concurrency')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='wsgi为进程内直接调用wsgi app，其余为gunicorn worker')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--warmup', type=float, default=0.5)
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--output', help='结果写入json文件')
+    parser.add_argument('--compare', help='与之前输出的json文件对比')
+    # 以下为HTTP模式下子进程内部使用
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--bind', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-class', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    modes = [m for m in args.modes.split(',') if m]
+    endpoints = [e for e in args.endpoints.split(',') if e]
+    for name in modes:
+        if name not in MODES:
+            parser.error('unknown mode: %s' % name)
+    for name in endpoints:
+        if name not in ENDPOINTS:
+            parser.error('unknown endpoint: %s' % name)
+
+    log.setup(stdout=False)
+    print('cpu count %d, concurrency %d, %ss per case, %d workers' % (
+        multiprocessing.cpu_count(), args.concurrency, args.seconds,
+        args.workers))
+    print('%-8s %-8s %8s %10s %10s %10s %8s %8s' % (
+        'mode', 'endpoint', 'requests', 'req/s', 'p50 ms', 'p99 ms',
+        'rss MB', 'errors'))
+
+    results = []
+    for mode in modes:
+        if mode == 'wsgi':
+            app = DNApp.register_view_func()
+            proc, target = None, None
+        else:
+            if mode == 'gevent':
+                try:
+                    import gevent  # noqa
+                except ImportError:
+                    print('%-8s skipped, gevent not installed' % mode)
+                    continue
+            proc, target = start_server(mode, args.workers, args.threads)
+        try:
+            for name in endpoints:
+                path, params = ENDPOINTS[name]
+                if proc is None:
+                    def make_requester():
+                        return wsgi_requester(app.flaskapp, path, params)
+                else:
+                    def make_requester():
+                        return http_requester(target, path, params)
+                item = {'mode': mode, 'endpoint': name,
+                        'concurrency': args.concurrency}
+                item.update(drive(make_requester, args.concurrency,
+                                  args.seconds, args.warmup))
+                item['rss_mb'] = rss_mb(proc.pid if proc else None)
+                results.append(item)
+                print('%-8s %-8s %8d %10.1f %10.3f %10.3f %8.1f %8d' % (
+                    mode, name, item['requests'], item['rps'],
+                    item['p50_ms'] or 0, item['p99_ms'] or 0,
+                    item['rss_mb'], item['errors']))
+        finally:
+            if proc is not None:
+                stop_server(proc)
+
+    if args.output:
+        meta = {
+            'commit': git_commit(),
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'seconds': args.seconds,
+            'workers': args.workers,
+            'threads': args.threads,
+            'endpoints': dict((name, {'path': ENDPOINTS[name][0],
+                                      'params': ENDPOINTS[name][1]})
+                              for name in endpoints),
+        }
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2,
+                      sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+对比view中手写的参数读取、校验与编译生成的绑定函数的耗时。
+
+- hand    手写的 self._request_data.get + 类型转换 + 范围检查
+- loop    每次请求遍历声明的参数逐个解释执行（不预先编译时的做法）
+- binder  注册路由时编译生成的绑定函数
+
+    PYTHONPATH=. python benchmarks/bench_params.py --number 200000 --requests 5000
+"""
+import argparse
+import inspect
+import time
+from typing import List
+
+from werkzeug.datastructures import (CombinedMultiDict, ImmutableMultiDict,
+                                     MultiDict)
+
+from dn.app import DNApp, DNView, Param, params
+from dn.common import log
+from dn.common.binding import (REQUIRED, compile_binder, declared_params,
+                               resolve)
+from dn.common.exceptions import ParameterError
+
+
+def hand(data):
+    """view中常见的手写读取和校验。"""
+    try:
+        user_id = int(data['user_id'])
+    except KeyError:
+        raise ParameterError(400, 'missing parameter: user_id')
+    except (TypeError, ValueError):
+        raise ParameterError(400, 'invalid parameter user_id')
+    try:
+        page = int(data.get('page', 1))
+        limit = int(data.get('limit', 20))
+    except (TypeError, ValueError):
+        raise ParameterError(400, 'invalid parameter page or limit')
+    if page < 1 or not 1 <= limit <= 100:
+        raise ParameterError(400, 'invalid parameter page or limit')
+    order = data.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ParameterError(400, 'invalid parameter order')
+    if hasattr(data, 'getlist'):
+        tags = data.getlist('tags')
+    else:
+        tags = data.get('tags') or []
+    return {'user_id': user_id, 'page': page, 'limit': limit,
+            'order': order, 'tags': tags}
+
+
+class BenchParamsView(DNView):
+    def params_hand(self):
+        return hand(self._request_data)
+
+    @params(page=Param(int, min=1), limit=Param(int, min=1, max=100),
+            order=Param(str, choices=['asc', 'desc']))
+    def params_bound(self, user_id: int, page=1, limit=20, order='asc',
+                     tags: List[str] = None):
+        return {'user_id': user_id, 'page': page, 'limit': limit,
+                'order': order, 'tags': tags or []}
+
+
+def make_loop(func):
+    """每次调用都按声明的参数解释执行的校验。"""
+    fields = []
+    for name, spec, default in declared_params(func):
+        convert, is_list = resolve(spec.type)[:2]
+        fields.append((name, spec, default, convert, is_list))
+
+    def loop(data):
+        kwargs = {}
+        for name, spec, default, convert, is_list in fields:
+            key = spec.alias or name
+            if is_list and hasattr(data, 'getlist'):
+                value = data.getlist(key) or None
+            else:
+                value = data.get(key)
+            if value is None:
+                if spec.default is not REQUIRED:
+                    kwargs[name] = spec.default
+                elif default is inspect.Parameter.empty:
+                    raise ParameterError(400, 'missing parameter: %s' % key)
+                continue
+            try:
+                value = convert(value)
+            except (TypeError, ValueError):
+                raise ParameterError(400, 'invalid parameter %s' % key)
+            measure = len(value) if isinstance(value, (str, list)) else value
+            if spec.min is not None and measure < spec.min:
+                raise ParameterError(400, 'invalid parameter %s' % key)
+            if spec.max is not None and measure > spec.max:
+                raise ParameterError(400, 'invalid parameter %s' % key)
+            if spec.choices is not None and value not in spec.choices:
+                raise ParameterError(400, 'invalid parameter %s' % key)
+            kwargs[name] = value
+        return kwargs
+    return loop
+
+
+def per_call(func, data, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        try:
+            func(data)
+        except ParameterError:
+            pass
+    return (time.perf_counter() - started) / number * 1e9
+
+
+def best_per_call(funcs, data, number, repeat):
+    """几种实现轮流执行repeat轮，各取最快的一轮，减少机器负载波动的影响。"""
+    costs = [None] * len(funcs)
+    for _ in range(repeat):
+        for i, func in enumerate(funcs):
+            cost = per_call(func, data, number // repeat)
+            costs[i] = cost if costs[i] is None else min(costs[i], cost)
+    return costs
+
+
+def requests_per_second(client, url, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        client.get(url)
+    return number / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=200000,
+                        help='每种校验方式调用的次数')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='端到端每个view请求的次数，0为不测')
+    args = parser.parse_args()
+
+    func = BenchParamsView.params_bound
+    binder = compile_binder(func)
+    loop = make_loop(func)
+    query = ImmutableMultiDict([('user_id', '42'), ('page', '3'),
+                                ('limit', '50'), ('order', 'desc'),
+                                ('tags', 'a'), ('tags', 'b')])
+    inputs = [
+        ('json', {'user_id': 42, 'page': 3, 'limit': 50, 'order': 'desc',
+                  'tags': ['a', 'b']}),
+        ('query', query),
+        # GET请求的request.values
+        ('values', CombinedMultiDict([query, ImmutableMultiDict()])),
+        ('minimal', {'user_id': '42'}),
+    ]
+    inputs.append(('invalid', {'user_id': '42', 'limit': '500'}))
+
+    print('%-10s %10s %10s %10s %8s' % ('input', 'hand ns', 'loop ns',
+                                        'binder ns', 'speedup'))
+    for name, data in inputs:
+        costs = best_per_call((hand, loop, binder), data, args.number,
+                              args.repeat)
+        print('%-10s %10.0f %10.0f %10.0f %7.2fx' % (
+            name, costs[0], costs[1], costs[2], costs[0] / costs[2]))
+
+    if not args.requests:
+        return
+    log.setup(stdout=False)
+    app = DNApp.register_view_func()
+    client = app.flaskapp.test_client()
+    query = 'user_id=42&page=3&limit=50&order=desc&tags=a&tags=b'
+    print()
+    print('%-10s %12s' % ('view', 'req/s'))
+    for url in ('/params/hand', '/params/bound'):
+        client.get('%s?%s' % (url, query))
+        rps = requests_per_second(client, '%s?%s' % (url, query),
+                                  args.requests)
+        print('%-10s %12.1f' % (url.rsplit('/', 1)[1], rps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+CPU密集型view在线程中执行与交给进程池执行的吞吐量对比，进程池的吞吐量应当
+随子进程数（不超过cpu核数）近似线性增长，线程受GIL限制不随线程数增长。
+
+    python benchmarks/bench_procpool.py --requests 200 --work 200000
+"""
+import argparse
+import multiprocessing
+import threading
+import time
+
+from dn.app import DNApp, DNView, cpu_bound
+from dn.common import log
+from dn.common.procpool import procpool
+
+
+def burn(n):
+    total = 0
+    for i in range(n):
+        total += i * i % 7
+    return total
+
+
+class BenchCPUView(DNView):
+    def bench_cpu_thread(self):
+        return {'total': burn(int(self._request_data['work']))}
+
+    @cpu_bound()
+    def bench_cpu_process(self):
+        return {'total': burn(int(self._request_data['work']))}
+
+
+def run(client, path, requests, concurrency, work):
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            client.get(path, query_string={'work': work})
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return requests / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--work', type=int, default=200000)
+    parser.add_argument('--max-workers', type=int,
+                        default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    log.setup(stdout=False)
+    app = DNApp.register_view_func()
+    client = app.flaskapp.test_client()
+    print('cpu count %d, work %d per request' % (
+        multiprocessing.cpu_count(), args.work))
+    print('%-8s %8s %12s' % ('mode', 'workers', 'req/s'))
+
+    counts = sorted(set([1, 2, 4, 8, 16, args.max_workers]))
+    counts = [n for n in counts if n <= args.max_workers]
+    for n in counts:
+        rps = run(client, '/bench/cpu/thread', args.requests, n, args.work)
+        print('%-8s %8d %12.1f' % ('thread', n, rps))
+    for n in counts:
+        procpool.configure(workers=n)
+        procpool.warmup()
+        rps = run(client, '/bench/cpu/process', args.requests, n * 2, args.work)
+        print('%-8s %8d %12.1f' % ('process', n, rps))
+        procpool.executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
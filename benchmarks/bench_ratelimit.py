@@ -0,0 +1,76 @@
+"""
+限流给每个请求增加的开销：单次令牌桶检查的耗时，以及经过完整请求处理时
+开启/关闭限流的对比。
+
+    python benchmarks/bench_ratelimit.py --requests 5000
+    python benchmarks/bench_ratelimit.py --redis redis://127.0.0.1:6379/0
+"""
+import argparse
+import time
+
+from dn.app import DNApp, DNView
+from dn.common import log
+from dn.common.ratelimit import MemoryBuckets, RedisBuckets, ratelimiter
+from dn.common.wrappers import RedisStore
+
+
+class BenchRateLimitView(DNView):
+    def bench_ratelimit(self):
+        return {'ok': 1}
+
+
+def bench_take(buckets, n, clients):
+    started = time.perf_counter()
+    for i in range(n):
+        buckets.take('bench:%d' % (i % clients), 1e9, 1e9)
+    return (time.perf_counter() - started) / n
+
+
+def bench_requests(client, n, rounds=5):
+    costs = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(n):
+            client.get('/bench/ratelimit')
+        costs.append((time.perf_counter() - started) / n)
+    return min(costs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--redis', help='redis url, 不指定时只测试进程内令牌桶')
+    args = parser.parse_args()
+
+    log.setup(stdout=False)
+    backends = [('memory', MemoryBuckets())]
+    if args.redis:
+        backends.append(('redis', RedisBuckets(RedisStore.create(args.redis),
+                                               'dn:bench:ratelimit:')))
+
+    print('%-8s %12s' % ('backend', 'us/check'))
+    for name, buckets in backends:
+        cost = bench_take(buckets, args.requests, args.clients)
+        print('%-8s %12.2f' % (name, cost * 1e6))
+
+    app = DNApp.register_view_func()
+    client = app.flaskapp.test_client()
+    rules = [{'match': '/bench/ratelimit', 'by': 'remote_addr',
+              'rate': 1e9, 'burst': 1e9}]
+    print()
+    print('%-8s %12s %12s' % ('backend', 'us/request', 'overhead'))
+    ratelimiter.configure(backend='memory', rules=[])
+    bench_requests(client, 500, rounds=1)
+    baseline = bench_requests(client, args.requests)
+    print('%-8s %12.2f %12s' % ('off', baseline * 1e6, '-'))
+    for name, buckets in backends:
+        ratelimiter.configure(backend='memory', rules=rules)
+        ratelimiter.buckets = buckets
+        cost = bench_requests(client, args.requests)
+        print('%-8s %12.2f %12.2f' % (name, cost * 1e6,
+                                      (cost - baseline) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
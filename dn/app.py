@@ -1,52 +1,245 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import inspect
+import logging
+import math
 import os
+import signal
 import sys
 import time
 import traceback
-from urllib.parse import urlparse
+import types
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
-from flask import Blueprint, Flask, g, json, jsonify, request, Response
+from flask import (Blueprint, Flask, copy_current_request_context,
+                   current_app, g, json, jsonify, request, Response,
+                   stream_with_context)
+from flask.ctx import _AppCtxGlobals
 
-from dn.common import log, sqldb
+from dn.common import aio, log, sqldb
+from dn.common.admission import admission
 from dn.common.app import DNEnv
-from dn.common.exceptions import AppBaseException, RequestDataException
-# from dn.common.globals import config
+from dn.common.binding import Param, compile_binder  # noqa
+from dn.common.cache import response_cache
+from dn.common.compress import compressor
+from dn.common.cors import CORSMiddleware, cors
+from dn.common.errors import traceback_limiter
+from dn.common.exceptions import (AppBaseException, OverloadedError,
+                                  ParameterError, RateLimitedError)
+from dn.common.globals import config
+from dn.common.health import health
+from dn.common.jobs import jobs
+from dn.common.local import LocalStack
+from dn.common.metrics import registry
+from dn.common.payload import RequestPayload
+from dn.common.procpool import procpool
+from dn.common.profiler import profiler
+from dn.common.ratelimit import ratelimiter
+from dn.common.reload import reloader, unique_classes
+from dn.common.serializer import serializer
+from dn.common.shutdown import close_redis_pools, shutdown
+from dn.common.singleflight import coalescer
+from dn.common.tracing import tracer
 
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import Forbidden, HTTPException, NotFound
 
 logger = log.get_logger()
 
+# 协程view在事件循环线程中执行，取不到flask的request，请求数据通过它传入
+_async_request_data = contextvars.ContextVar('dn_async_request_data',
+                                             default=None)
+# 批量接口等在进程内调用view时，用它覆盖当前线程的请求数据
+_request_data_stack = LocalStack()
+
+
+# 合并请求时不共用的响应头
+COALESCE_PRIVATE_HEADERS = frozenset(['content-length', 'set-cookie'])
+
 
 class AppIsNotMountableException(Exception):
     pass
 
 
+def json_response(data, response_class=None):
+    if serializer.backend == 'flask':
+        return jsonify(data)
+    if response_class is None:
+        response_class = current_app.response_class
+    return response_class(serializer.dumps(data), mimetype='application/json')
+
+
+def stream(format='ndjson'):
+    """
+    view方法yield数据时的输出格式：ndjson 每行一个json，json 输出一个json数组。
+    没有使用该装饰器的生成器view默认输出ndjson。
+    """
+    if format not in ('ndjson', 'json'):
+        raise RuntimeError('unknown stream format: %s' % format)
+
+    def decorator(func):
+        func._dn_stream_format = format
+        return func
+    return decorator
+
+
+def cached(ttl=None):
+    """
+    缓存view序列化之后的响应，key为rule名称加上请求数据，ttl为None时使用配置中的ttl。
+    写操作之后可以调用self._invalidate_cache(rule)使缓存失效。
+    """
+    def decorator(func):
+        func._dn_cache = {'ttl': ttl}
+        return func
+    return decorator
+
+
+def coalesce(distributed=False):
+    """
+    合并rule和请求数据都相同的并发请求，只执行一次view，所有请求共用结果。
+    distributed为True时通过redis锁在多个worker和机器之间合并。
+    只适合结果与调用者无关的只读接口，不能用于生成器view。
+    """
+    def decorator(func):
+        func._dn_coalesce = {'distributed': distributed}
+        return func
+    return decorator
+
+
+def cpu_bound(timeout=None):
+    """
+    在进程池中执行CPU密集型的view，不再因为GIL阻塞同一个worker中的其他请求。
+    请求数据必须可以pickle，view中只能通过self._request_data读取请求数据，
+    返回值必须可以pickle。超过timeout秒没有返回时响应504。
+    """
+    def decorator(func):
+        func._dn_process = {'timeout': timeout}
+        return func
+    return decorator
+
+
+def job(pool='thread'):
+    """
+    把view作为后台任务执行，调用时立即返回任务id，通过 /_jobs/<job_id> 查询状态，
+    /_jobs/<job_id>/result 获取结果。pool为process时在子进程中执行，请求数据
+    必须可以pickle，view中只能通过self._request_data读取请求数据。
+    """
+    if pool not in ('thread', 'process'):
+        raise RuntimeError('unknown job pool: %s' % pool)
+
+    def decorator(func):
+        func._dn_job = {'pool': pool}
+        return func
+    return decorator
+
+
+def etag(version_func):
+    """
+    由view提供版本号作为ETag，version_func(self)应当比计算响应本身廉价得多。
+    请求的If-None-Match与版本号一致时直接返回304，不再执行view。
+    """
+    def decorator(func):
+        func._dn_etag = version_func
+        return func
+    return decorator
+
+
+def params(**schema):
+    """
+    声明view方法参数的类型和约束，值为类型或者Param：
+    @params(limit=Param(int, min=1, max=100), keyword=str)
+    与类型注解的作用相同，注册路由时编译成绑定函数，参见 dn.common.binding。
+    """
+    def decorator(func):
+        func._dn_params = schema
+        return func
+    return decorator
+
+
 class DNResponse(Response):
     @classmethod
     def force_type(cls, response, environ=None):
         if isinstance(response, (list, dict)):
-            response = jsonify(response)
+            response = json_response(response, cls)
         return super(Response, cls).force_type(response, environ)
 
 
 class DNFlask(Flask):
     def make_response(self, response):
         if isinstance(response, (list, dict)):
-            response = jsonify(response)
+            response = json_response(response, self.response_class)
+        elif isinstance(response, types.GeneratorType):
+            response = self.stream_response(response)
         return super().make_response(response)
 
+    def stream_response(self, rows):
+        view_func = self.view_functions.get(request.endpoint)
+        if getattr(view_func, '_dn_stream_format', 'ndjson') == 'json':
+            body = serializer.iter_json_array(rows)
+            mimetype = 'application/json'
+        else:
+            body = serializer.iter_ndjson(rows)
+            mimetype = 'application/x-ndjson'
+        # 保持请求上下文直到输出结束，view中可以继续使用request和数据库session
+        return self.response_class(stream_with_context(body), mimetype=mimetype)
+
+
+class DNGlobals(_AppCtxGlobals):
+    """
+    g.payload在第一次用到时创建，g.rawdata和g.jsondata都从它取，
+    请求体在一个请求中最多解析一次。g属于app上下文，同一个app上下文中可能
+    处理多个请求（测试、脚本中只push一次app_context），解析结果保存在request上。
+    """
+
+    @property
+    def payload(self):
+        req = request._get_current_object()
+        payload = getattr(req, '_dn_payload', None)
+        if payload is None:
+            payload = RequestPayload(
+                req, current_app.config.get('MAX_CONTENT_LENGTH'))
+            req._dn_payload = payload
+        return payload
+
+    @property
+    def rawdata(self):
+        return self.payload.rawdata
+
+    @property
+    def jsondata(self):
+        req = request._get_current_object()
+        if hasattr(req, '_dn_jsondata'):
+            return req._dn_jsondata
+        return self.payload.jsondata
+
+    @jsondata.setter
+    def jsondata(self, value):
+        request._get_current_object()._dn_jsondata = value
+
 
 class DNView(object):
 
     @property
     def _request_data(self):
-        try:
-            jsondata = request.get_json() or request.values
-        except Exception:
-            jsondata = request.values
-        return jsondata
+        data = _async_request_data.get()
+        if data is not None:
+            return data
+        data = _request_data_stack.top
+        if data is not None:
+            return data
+        return g.payload.data
+
+    def _invalidate_cache(self, rule, data=None):
+        response_cache.invalidate(rule, data)
 
 
 class DNApp(DNEnv):
+    # /_batch 一次最多包含的子请求个数，以及并发执行子请求的线程数
+    batch_max_items = 50
+    batch_max_workers = 8
+
     def __init__(self, name_or_app, config_file="config.yaml"):
         if isinstance(name_or_app, Flask):
             import_name = name_or_app.import_name
@@ -57,6 +250,7 @@ class DNApp(DNEnv):
 
         # 加入自己的Response
         self.app.response_class = DNResponse
+        self.app.app_ctx_globals_class = DNGlobals
 
         if os.path.isabs(config_file):
             self.config_file = config_file
@@ -64,10 +258,181 @@ class DNApp(DNEnv):
             self.config_file = os.path.join(self.app.root_path, config_file)
         super(DNApp, self).__init__(import_name, config_file=self.config_file)
         self.app.add_url_rule("/health_check", view_func=self._health_check)
+        self.app.add_url_rule("/health/live", view_func=self._health_live)
+        self.app.add_url_rule("/health/ready", view_func=self._health_ready)
+        self.app.add_url_rule("/_batch", view_func=self._batch, methods=['POST'])
+        self.app.add_url_rule("/metrics", view_func=self._metrics)
+        self.app.add_url_rule("/_jobs/<job_id>", view_func=self._job_status)
+        self.app.add_url_rule("/_jobs/<job_id>/result",
+                              view_func=self._job_result)
+        self.app.add_url_rule("/_profiles", view_func=self._profiles)
+        self.app.add_url_rule("/_profiles/<path:name>", view_func=self._profile)
+        self.app.add_url_rule("/_reload", view_func=self._reload,
+                              methods=['POST'])
+        self._batch_executor = None
+        self._batch_executor_pid = None
+        self._mounts = []
 
     def _health_check(self):
         return "DN works!"
 
+    def _health_live(self):
+        # 只说明进程还能处理请求，不检查依赖，依赖出错时不应当重启worker
+        return json_response({'status': 'ok'})
+
+    def _health_ready(self):
+        status = health.status()
+        response = json_response(status)
+        if status['status'] != 'ok':
+            # 负载均衡只看HTTP状态码
+            response.status_code = 503
+        return response
+
+    def _metrics(self):
+        return Response(
+            registry.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def _job_status(self, job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            raise NotFound()
+        job.pop('body', None)
+        job.pop('mimetype', None)
+        return json_response(job)
+
+    def _job_result(self, job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            raise NotFound()
+        if 'body' not in job:
+            # 还没有执行完，返回任务状态
+            response = self._job_status(job_id)
+            response.status_code = 202
+            return response
+        return Response(job['body'], mimetype=job['mimetype'])
+
+    def check_profiles_access(self):
+        # profile中有代码路径和参数，没有开启时不暴露，配置了token时校验请求头
+        if not profiler.enabled:
+            raise NotFound()
+        if profiler.token \
+                and request.headers.get('X-Profile-Token') != profiler.token:
+            raise Forbidden()
+
+    def _profiles(self):
+        self.check_profiles_access()
+        limit = request.args.get('limit', '50')
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ParameterError(400, 'invalid parameter limit')
+        if limit < 1:
+            raise ParameterError(400, 'invalid parameter limit')
+        return json_response(profiler.recent(limit))
+
+    def _profile(self, name):
+        self.check_profiles_access()
+        text = profiler.render(name)
+        if text is None:
+            raise NotFound()
+        return Response(text, mimetype='text/plain')
+
+    def _reload(self):
+        if not reloader.enabled:
+            raise NotFound()
+        # 没有配置token时拒绝所有请求，任何客户端都不能让master重启worker
+        if not reloader.token \
+                or request.headers.get('X-Reload-Token') != reloader.token:
+            raise Forbidden()
+        if reloader.master_pid is None:
+            # 不是由gunicorn启动的，没有master可以通知
+            response = json_response({'status': 'unsupported'})
+            response.status_code = 501
+            return response
+        os.kill(reloader.master_pid, signal.SIGHUP)
+        response = json_response({'status': 'reloading',
+                                  'master': reloader.master_pid})
+        response.status_code = 202
+        return response
+
+    def _batch(self):
+        """
+        一次请求中调用多个view，请求体为[{"path": "/get/info", "data": {...}}, ...]，
+        或者{"requests": [...], "concurrent": true}，并发执行各个子请求。
+        按顺序返回每个子请求的path、status和body，单个子请求出错不影响其他子请求。
+        """
+        payload = request.get_json(silent=True)
+        concurrent = False
+        if isinstance(payload, dict):
+            concurrent = bool(payload.get('concurrent'))
+            payload = payload.get('requests')
+        if not isinstance(payload, list):
+            raise ParameterError(400, 'batch body must be a list of {path, data}')
+        if len(payload) > self.batch_max_items:
+            raise ParameterError(
+                400, 'too many sub requests, at most %d' % self.batch_max_items)
+
+        if concurrent and len(payload) > 1:
+            # 每个子请求都要复制一份请求上下文，不能在多个线程中共用。复制的
+            # 上下文在线程池的线程中pop时执行teardown_request，清理该线程的db session
+            futures = [self.batch_executor.submit(
+                tracer.thread_context().run,
+                copy_current_request_context(self.dispatch_subrequest),
+                item) for item in payload]
+            return [future.result() for future in futures]
+        return [self.dispatch_subrequest(item) for item in payload]
+
+    @property
+    def batch_executor(self):
+        if self._batch_executor is None or self._batch_executor_pid != os.getpid():
+            self._batch_executor = ThreadPoolExecutor(self.batch_max_workers)
+            self._batch_executor_pid = os.getpid()
+        return self._batch_executor
+
+    def dispatch_subrequest(self, item):
+        path = item.get('path') if isinstance(item, dict) else None
+        try:
+            if not path:
+                raise ParameterError(400, 'sub request must be {path, data}')
+            adapter = self.app.create_url_adapter(request)
+            rule, values = adapter.match(path, method='POST',
+                                         return_rule=True)
+            if rule.endpoint == '_batch':
+                raise ParameterError(400, 'nested batch is not allowed')
+            limiter = None
+            if not rule.endpoint.startswith('_'):
+                # /_batch本身是内部接口，子请求按各自的rule限流和过载保护
+                wait = ratelimiter.check(rule.rule)
+                if wait:
+                    raise RateLimitedError(retry_after=wait)
+                limiter, reason = admission.acquire(rule.rule)
+                if reason is not None:
+                    raise OverloadedError('Service Overloaded: %s' % reason,
+                                          retry_after=admission.retry_after)
+            view_func = self.app.view_functions[rule.endpoint]
+            _request_data_stack.push(item.get('data') or {})
+            try:
+                rv = view_func(**values)
+                if isinstance(rv, types.GeneratorType):
+                    rv = list(rv)
+                response = self.app.make_response(rv)
+            finally:
+                _request_data_stack.pop()
+                if limiter is not None:
+                    limiter.release()
+        except Exception as error:
+            if not isinstance(error, HTTPException):
+                self.log_exception('batch_error', error, path)
+            code, body = self.error_body(error)
+            return {'path': path, 'status': code, 'body': body}
+
+        if response.is_json:
+            body = response.get_json()
+        else:
+            body = response.get_data(as_text=True)
+        return {'path': path, 'status': response.status_code, 'body': body}
+
     @property
     def flaskapp(self):
         return self.app
@@ -75,26 +440,241 @@ class DNApp(DNEnv):
     @classmethod
     def init(cls):
         app = cls('')
-        app.init_app()
         return app
 
     @classmethod
     def register_view_func(app_cls):
+        """把所有DNView子类的公有方法注册为view，注册完成后打印一行汇总日志。"""
         app = app_cls.init()
-        for cls in [cls for cls in DNView.__subclasses__()]:
+        started = time.time()
+        classes = unique_classes(DNView.__subclasses__())
+        rules = 0
+        for cls in classes:
             obj = cls()
-            public_props = (name for name in dir(obj) if not name.startswith('_'))
-            print(' * Public Rules as Belows:')
-            for props in public_props:
-                if hasattr(getattr(obj, props), '__call__'):
-                    rule_name = '/' + props.replace('_', '/')
-                    print(rule_name)
-                    app.flaskapp.add_url_rule(rule_name, view_func=getattr(obj, props), methods=['GET', 'POST'])
+            # 按实例取属性，__init__中设置在实例上的可调用对象同样注册
+            for props in dir(obj):
+                if props.startswith('_'):
+                    continue
+                func = getattr(obj, props)
+                if not callable(func):
+                    continue
+                rule_name = '/' + props.replace('_', '/')
+                view_func = app.make_view_func(rule_name, func, obj)
+                app.flaskapp.add_url_rule(rule_name, view_func=view_func,
+                                          methods=['GET', 'POST'])
+                rules += 1
 
+        logger.info('REGISTER_VIEW_FUNC',
+                    ('views', len(classes)),
+                    ('rules', rules),
+                    ('cost_ms', int((time.time() - started) * 1000)))
         return app
 
+    def make_view_func(self, rule_name, func, view):
+        binder = compile_binder(func)
+        job = getattr(func, '_dn_job', None)
+        if job is None and rule_name in jobs.views:
+            job = jobs.views[rule_name] or {}
+        job_binder = None
+        if job is not None:
+            # 任务view在提交之前绑定参数，参数错误时直接返回，不会成为失败的任务
+            job_binder, binder = binder, None
+        process = getattr(func, '_dn_process', None)
+        if process is None and rule_name in procpool.views:
+            process = procpool.views[rule_name] or {}
+        if process is not None:
+            # 在子进程中调用原来的方法，协程也在子进程中执行
+            func = self.wrap_process(view, func, process.get('timeout'),
+                                     binder)
+        elif asyncio.iscoroutinefunction(func):
+            func = self.wrap_coroutine(view, func, binder)
+        elif binder is not None:
+            func = self.wrap_params(view, func, binder)
+        if job is not None:
+            # 任务view立即返回任务id，不再使用缓存、合并和ETag
+            if job.get('pool') == 'process' and process is None:
+                func = self.wrap_process(view, func)
+            return self.wrap_trace(rule_name, self.wrap_job(
+                view, rule_name, func, job_binder))
+        version_func = getattr(func, '_dn_etag', None)
+        coalesce = getattr(func, '_dn_coalesce', None)
+        if coalesce is None and rule_name in coalescer.views:
+            coalesce = coalescer.views[rule_name] or {}
+        if coalesce is not None:
+            func = self.wrap_coalesce(view, rule_name, func,
+                                      coalesce.get('distributed', False))
+        cache = getattr(func, '_dn_cache', None)
+        if cache is None and rule_name in response_cache.views:
+            cache = {'ttl': response_cache.views[rule_name]}
+        if cache is not None:
+            func = self.wrap_cache(view, rule_name, func, cache['ttl'])
+        if version_func is not None:
+            func = self.wrap_etag(view, func, version_func)
+        return self.wrap_trace(rule_name, func)
+
+    def wrap_trace(self, rule_name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span('view', rule=rule_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def wrap_params(self, view, func, binder):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            kwargs.update(binder(view._request_data))
+            return func(*args, **kwargs)
+        return wrapper
+
+    def wrap_etag(self, view, func, version_func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(*args, **kwargs)
+            tag = str(version_func(view))
+            if request.if_none_match.contains_weak(tag):
+                response = self.app.response_class(status=304)
+            else:
+                response = self.app.make_response(func(*args, **kwargs))
+            response.set_etag(tag)
+            return response
+        return wrapper
+
+    def wrap_cache(self, view, rule_name, func, ttl):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            data = view._request_data
+            cached_response = response_cache.get(rule_name, data)
+            if cached_response is not None:
+                mimetype, body = cached_response
+                return self.app.response_class(body, mimetype=mimetype)
+            response = self.app.make_response(func(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(rule_name, data, response.mimetype,
+                                   response.get_data(), ttl)
+            return response
+        return wrapper
+
+    def wrap_coalesce(self, view, rule_name, func, distributed):
+        if inspect.isgeneratorfunction(inspect.unwrap(func)):
+            raise RuntimeError('generator view %s can not be coalesced'
+                               % rule_name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            own = []
+
+            def execute():
+                response = self.app.make_response(func(*args, **kwargs))
+                own.append(response)
+                # ETag、Cache-Control等响应头和响应体一起共用，Set-Cookie属于
+                # 执行view的调用者，不能交给其他人；Content-Length由响应体重新计算
+                headers = [(name, value) for name, value in response.headers
+                           if name.lower() not in COALESCE_PRIVATE_HEADERS]
+                return response.status_code, headers, response.get_data()
+            status, headers, body = coalescer.do(
+                rule_name, view._request_data, execute, distributed)
+            if own:
+                # 自己执行的view，返回完整的响应
+                return own[0]
+            return self.app.response_class(body, status=status,
+                                           headers=headers)
+        return wrapper
+
+    def wrap_job(self, view, rule_name, func, binder=None):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            data = view._request_data
+            if binder is not None:
+                kwargs.update(binder(data))
+
+            def execute():
+                _request_data_stack.push(data)
+                try:
+                    rv = func(*args, **kwargs)
+                    if isinstance(rv, types.GeneratorType):
+                        rv = list(rv)
+                    response = self.app.make_response(rv)
+                    code = response.status_code
+                except Exception as error:
+                    self.log_exception('job_error', error, rule_name)
+                    code, body = self.error_body(error)
+                    response = json_response(body)
+                finally:
+                    _request_data_stack.pop()
+                return code, response.mimetype, response.get_data()
+
+            # 任务在请求结束之后执行，复制一份请求上下文
+            job = jobs.submit(rule_name, copy_current_request_context(execute))
+            if job is None:
+                raise OverloadedError('Too Many Pending Jobs',
+                                      retry_after=admission.retry_after)
+            response = json_response({'job_id': job['id'],
+                                      'status': job['status']})
+            response.status_code = 202
+            response.headers['Location'] = '%s/_jobs/%s' % (
+                request.script_root, job['id'])
+            return response
+        return wrapper
+
+    def wrap_process(self, view, func, timeout=None, binder=None):
+        cls = view.__class__
+        attr = func.__name__
+        procpool.add_preload(cls)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            data = view._request_data
+            if binder is not None:
+                # 在父进程中绑定参数，参数错误时不占用子进程
+                kwargs.update(binder(data))
+            if hasattr(data, 'to_dict'):
+                # request.values 等 MultiDict 不能直接传给子进程
+                data = data.to_dict()
+            try:
+                return procpool.call_view(cls, attr, data, timeout, kwargs)
+            except FuturesTimeoutError:
+                raise AppBaseException(504, 'Process Pool Timeout')
+        return wrapper
+
+    def wrap_coroutine(self, view, func, binder=None):
+        async def call_with_request_data(data, args, kwargs):
+            _async_request_data.set(data)
+            return await func(*args, **kwargs)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # 在请求线程中先取出请求数据，协程中的self._request_data读取的是这份数据
+            data = view._request_data
+            if binder is not None:
+                kwargs.update(binder(data))
+            return aio.run_coroutine(call_with_request_data(data, args, kwargs),
+                                     context=tracer.thread_context())
+        return wrapper
+
     def init_app(self):
         # self.app.config.update(config)
+        serializer.configure(**config.json)
+        response_cache.configure(**config.cache)
+        self.etag_enabled = config.etag.get('enabled', True)
+        compressor.configure(**config.compress)
+        self.app.config['MAX_CONTENT_LENGTH'] = config.request_max_body_size
+        self.init_metrics()
+        profiler.configure(**config.profile)
+        admission.configure(**config.admission)
+        coalescer.configure(**config.coalesce)
+        jobs.configure(**config.jobs)
+        reloader.configure(**config.reload)
+        procpool.configure(**config.procpool)
+        self.init_ratelimit()
+        traceback_limiter.configure(**config.errors)
+        health.configure(**config.health)
+        tracer.configure(**config.tracing)
+        shutdown.configure(**config.shutdown)
+        shutdown.register(sqldb.dispose_engines)
+        shutdown.register(close_redis_pools)
+        cors.configure(**config.cors)
+        self.app.wsgi_app = CORSMiddleware(self.app.wsgi_app, cors)
         self.app.log = logger
         self.log = log.get_logger('api')
         self.app.before_request(self.before_request)
@@ -102,6 +682,48 @@ class DNApp(DNEnv):
         self.app.teardown_request(self.teardown_request)
         self.init_error_handler()
 
+    def init_metrics(self):
+        conf = config.metrics
+        self.metrics_enabled = conf.get('enabled', True)
+        registry.configure(**conf)
+        registry.describe('dn_requests_total', 'counter',
+                          'Requests by endpoint, method and response code.')
+        registry.describe('dn_request_duration_seconds', 'histogram',
+                          'Request latency until the response is ready.')
+        registry.describe('dn_request_duration_seconds_quantile', 'gauge',
+                          'p50/p95/p99 estimated from the latency histogram.')
+        registry.describe('dn_requests_in_flight', 'gauge',
+                          'Requests being processed.')
+        registry.describe('dn_cache_hits_total', 'counter',
+                          'Response cache hits by rule.')
+        registry.describe('dn_cache_misses_total', 'counter',
+                          'Response cache misses by rule.')
+        registry.describe('dn_admission_queue_depth', 'gauge',
+                          'Requests waiting for a concurrency slot.')
+        registry.describe('dn_admission_rejected_total', 'counter',
+                          'Requests shed by admission control.')
+        registry.describe('dn_ratelimit_rejected_total', 'counter',
+                          'Requests rejected by rate limit rules.')
+        registry.describe('dn_coalesced_total', 'counter',
+                          'Requests that shared the result of an identical '
+                          'in-flight request.')
+        registry.describe('dn_errors_total', 'counter',
+                          'Errors handled by error_handler by type and code.')
+        # 每个worker各自检查、各自的连接池，不能在worker之间求和
+        registry.describe('dn_dependency_up', 'gauge',
+                          'Whether the last background probe of a sqldb or '
+                          'redis instance succeeded in every worker.',
+                          merge='min')
+        registry.describe('dn_pool_saturation', 'gauge',
+                          'Checked out connections / pool capacity of the '
+                          'most saturated worker.', merge='max')
+        registry.register_collector(response_cache.metrics)
+
+    def init_ratelimit(self):
+        ratelimiter.register_key_func('remote_addr', lambda: request.remote_addr)
+        ratelimiter.register_key_func('app_id', self.get_appid_from_urlpath)
+        ratelimiter.configure(**config.ratelimit)
+
     def init_error_handler(self):
         self.app.register_error_handler(Exception, self.error_handler)
 
@@ -121,27 +743,47 @@ class DNApp(DNEnv):
         return path.strip('/').split('/')[0]
 
     def before_request(self):
-        logger.debug('REQUEST',
-                     ('url', request.base_url),
-                     ('endpoint', request.endpoint))
-        g.rawdata = request.get_data(cache=True, parse_form_data=False)
-        g.jsondata = {}
+        if tracer.enabled:
+            # 请求中的每一行日志都带上request id，内部接口不记录trace
+            g.request_id = tracer.request_id_of(request.environ)
+            tracer.start(g.request_id, sample=request.endpoint is not None
+                         and not request.endpoint.startswith('_'))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('REQUEST',
+                         ('url', request.base_url),
+                         ('endpoint', request.endpoint))
         if request.endpoint is None:
             return
         g.request_started = time.time()
         g.statsd_key = request.endpoint
+        # 退出时等待正在处理的请求结束
+        shutdown.enter()
+        g.shutdown_inflight = True
+        # /health_check、/metrics 等内部接口不做限流、过载保护和profile
+        internal = request.endpoint.startswith('_')
+        if not internal:
+            wait = ratelimiter.check(request.url_rule.rule)
+            if wait:
+                return self.response_error(RateLimitedError(retry_after=wait))
+            limiter, reason = admission.acquire(request.url_rule.rule)
+            if reason is not None:
+                # 直接返回响应，不进入error_handler，过载时拒绝请求的开销尽量小
+                return self.response_error(OverloadedError(
+                    'Service Overloaded: %s' % reason,
+                    retry_after=admission.retry_after))
+            g.admission_limiter = limiter
+        if self.metrics_enabled:
+            registry.add_gauge('dn_requests_in_flight',
+                               {'endpoint': g.statsd_key}, 1)
+            g.metrics_in_flight = True
+        if not internal:
+            g.profile = profiler.start()
 
-        self.log.debug('REQUEST',
-                       ('values', json.dumps(request.values.to_dict())))
-
-        content = request.values.get('content')
-
-        if content:
-            try:
-                g.jsondata = json.loads(content)
-            except Exception:
-                pass
-        self.log.debug('REQUEST', 'jsondata: %s' % (g.jsondata))
+        # 请求数据在用到时才解析，只有开启debug日志时才在这里解析并打印
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('REQUEST',
+                           ('values', json.dumps(request.values.to_dict())))
+            self.log.debug('REQUEST', 'jsondata: %s' % (g.jsondata))
 
     def teardown_request(self, exc):
         self.log.debug('teardown_request', exc)
@@ -149,80 +791,156 @@ class DNApp(DNEnv):
             self.log.error('SHOULD_NOT_HAPPEN',
                            'teardown_request, has exception:%s' % exc)
 
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
+        # after_request没有执行到（请求出错）时丢弃还没结束的profile
+        profiler.discard(g.pop('profile', None))
+        if g.pop('metrics_in_flight', False):
+            registry.add_gauge('dn_requests_in_flight',
+                               {'endpoint': g.statsd_key}, -1)
+            # 在减掉in flight之后写文件，否则文件中总是多算当前这个请求
+            registry.maybe_flush()
         sqldb.clear_dbsession()
+        if g.pop('shutdown_inflight', False):
+            shutdown.leave()
+        if tracer.enabled:
+            tracer.finish(endpoint=request.endpoint, method=request.method,
+                          path=request.path, code=g.get('trace_code'))
 
     def after_request(self, response):
         self.log.debug('after_request', response)
+        request_id = g.get('request_id')
+        if request_id is not None:
+            response.headers[tracer.header] = request_id
+            g.trace_code = getattr(g, 'response_code', None) \
+                or response.status_code
         if request.endpoint is None or response is None:
+            if response is not None and self.metrics_enabled:
+                code = getattr(g, 'response_code', None) \
+                    or response.status_code
+                registry.inc('dn_requests_total',
+                             {'endpoint': '', 'method': request.method,
+                              'code': code})
             return response
 
         code = -1
 
+        # 跨域的响应头按来源缓存，预检请求已经由CORSMiddleware在路由之前返回
+        cors.apply(response, request.environ)
+
+        if self.etag_enabled:
+            response = self.conditional_response(response)
+        response = compressor.compress_response(request, response)
+
+        if getattr(g, 'request_started', None) is not None:
+            t = (time.time() - g.request_started) * 1000
+            profile_path = profiler.stop(g.pop('profile', None),
+                                         request.endpoint, t)
+            code = getattr(g, 'response_code', None) or response.status_code
+            if code // 100 == 2 and t > config.request_slow_timeout:
+                self.log.error('SLOWREQUEST',
+                               'slow request of %s%s'
+                               % (request.script_root, request.path),
+                               {'request_url': request.url,
+                                'request_data': g.jsondata,
+                                'request_cost': t,
+                                'profile': profile_path})
+        if self.metrics_enabled:
+            self.record_metrics(response)
+        self.log_request(response, code)
+        return response
+
+    def record_metrics(self, response):
+        endpoint = g.statsd_key
+        code = getattr(g, 'response_code', None) or response.status_code
+        registry.inc('dn_requests_total',
+                     {'endpoint': endpoint, 'method': request.method,
+                      'code': code})
+        registry.observe('dn_request_duration_seconds', {'endpoint': endpoint},
+                         time.time() - g.request_started)
+
+    def conditional_response(self, response):
         """
-        为了解决跨域的问题，添加以下的头部返回给客户端
+        GET请求的响应没有ETag时按内容计算一个，与If-None-Match一致时返回304。
         """
-        header = response.headers
-        # 要发送cookie，这里就不能设置为*，必须明确指定 http://www.xiaoyaoji.cn 不包含最后的/ request.referrer[:-1]
-        if request.referrer is not None:
-            matches = urlparse(request.referrer)
-            header['Access-Control-Allow-Origin'] = matches.scheme + '://' + matches.netloc
-        else:
-            header['Access-Control-Allow-Origin'] = '*'
-        # 同意将cookie发送到服务器
-        header['Access-Control-Allow-Credentials'] = 'true'
-        header['Access-Control-Allow-Headers'] = 'Authorization, content-type'
-        header['Access-Control-Allow-Methods'] = 'GET, POST, DELETE'
-
-        # if getattr(g, 'request_started', None) is not None:
-        #     # t = (time.time() - g.request_started) * 1000
-        #     if getattr(g, 'response_code', None) is None:
-        #         code = response.status_code
-        #     else:
-        #         code = g.response_code
-        #     if code // 100 == 2:
-        #         if t > config.request_slow_timeout:
-        #             request_data = getattr(g, 'jsondata', None)
-        #             self.log.error('SLOWREQUEST',
-        #                            'slow request of %s%s'
-        #                            % (request.script_root, request.path),
-        #                            {'request_url': request.url,
-        #                             'request_data': request_data,
-        #                             'request_cost': t})
-        self.log_request(response, code)
+        if request.method not in ('GET', 'HEAD') \
+                or response.status_code != 200 \
+                or response.is_streamed \
+                or getattr(g, 'response_code', None) is not None:
+            return response
+        tag, _ = response.get_etag()
+        if tag is None:
+            tag = hashlib.blake2b(response.get_data(), digest_size=16).hexdigest()
+            response.set_etag(tag)
+        # 压缩之后返回的是弱ETag，这里按弱比较
+        if request.if_none_match.contains_weak(tag):
+            response.status_code = 304
+            response.set_data(b'')
         return response
 
     def error_handler(self, error):
         self.log.debug('error_handler', error)
+        if self.metrics_enabled:
+            registry.inc('dn_errors_total',
+                         {'type': error.__class__.__name__,
+                          'code': getattr(error, 'code', None) or 500})
 
-        request_data = getattr(g, 'jsondata', None)
-        if not isinstance(error, AppBaseException) \
-                and not isinstance(error, RequestDataException):
-            self.log.captureException(
-                request_url=request.url, request_data=request_data)
-
-        self.log.error('EXCEPTION', 'response_error', sys.exc_info()[1],
-                       getattr(error, "description", ""))
-        self.log.error('TRACEBACK', traceback.format_exc())
+        if isinstance(error, HTTPException):
+            # 404、405、业务异常等预期之内的错误只记录一行，不需要traceback，
+            # 扫描器访问大量不存在的url时不产生额外的开销
+            self.log.warning('EXCEPTION', 'response_error',
+                             error.__class__.__name__, error.code,
+                             getattr(error, 'description', ''))
+        else:
+            self.log_exception('response_error', error, capture=True)
 
         return self.response_error(error)
 
+    def log_exception(self, tag, error, *args, capture=False):
+        """
+        记录预期之外的异常，每次都记录一行EXCEPTION，同一位置的异常在一段时间内
+        只格式化、记录一次traceback。
+        """
+        suppressed = traceback_limiter.check(error)
+        self.log.error('EXCEPTION', tag, error, *args)
+        if suppressed is None:
+            return
+        if capture:
+            self.log.captureException(
+                request_url=request.url,
+                request_data=getattr(g, 'jsondata', None))
+        if suppressed:
+            self.log.error('EXCEPTION', tag,
+                           'suppressed %d duplicates' % suppressed)
+        self.log.error('TRACEBACK', traceback.format_exc())
+
     def response_error(self, error):
+        code, body = self.error_body(error)
+        g.response_code = code
+        response = json_response(body)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            # 需要客户端和负载均衡重试的错误使用真实的HTTP状态码
+            response.status_code = code
+            response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
+    def error_body(self, error):
         if isinstance(error, HTTPException):
-            g.response_code = error.code
             meta = {'code': error.code,
                     'error_type': error.__class__.__name__,
                     'error_message': error.description}
             if getattr(error, 'extra_info', None):
                 meta.update(error.extra_info)
             if error.response and isinstance(error.response, dict):
-                return jsonify(meta=meta, data=error.response)
+                return error.code, dict(meta=meta, data=error.response)
             else:
-                return jsonify(meta=meta)
+                return error.code, dict(meta=meta)
         else:
-            g.response_code = 500
-            return jsonify(meta={'code': 500, 'error_type':
-                                 error.__class__.__name__,
-                                 'error_message': str(error)})
+            return 500, dict(meta={'code': 500, 'error_type':
+                                   error.__class__.__name__,
+                                   'error_message': str(error)})
 
     def log_request(self, response, code=200):
         self.log.info('request',
@@ -235,6 +953,8 @@ class DNApp(DNEnv):
                       str(response.headers.get('Content-Length', '0')))
 
     def mount(self, block, mapping={}, skiplist=[]):
+        # 滚动更新时在新的app上重新mount
+        self._mounts.append((block, mapping, skiplist))
         block_name = block.__class__.__name__
         if block_name == 'module':
             block_name = block.__name__
@@ -265,16 +985,49 @@ class DNApp(DNEnv):
             raise AppIsNotMountableException(
                 '%s is not mountable, must be Blueproint' % obj)
 
-    def run(self, host="0.0.0.0", port=5000):
+    def run(self, host="0.0.0.0", port=5000, **options):
         """
         dn Application Server.
+        options传给werkzeug的run_simple，开启reloader（默认）时SIGTERM由reloader处理，
+        直接退出，不等待正在处理的请求。
         """
         from werkzeug.serving import run_simple
 
-        options = {}
+        shutdown.install()
         options.setdefault('use_reloader', True)
         options.setdefault('use_debugger', True)
-        run_simple(host,
-                   port,
-                   self.flaskapp,
-                   **options)
+        try:
+            run_simple(host,
+                       port,
+                       self.flaskapp,
+                       **options)
+        finally:
+            if shutdown.draining:
+                # serve loop已经停止，请求已经在信号处理的线程中等待过
+                shutdown.drain(timeout=0)
+
+    def serve(self, bind=None, **options):
+        """
+        dn Production Server, prefork workers managed by gunicorn.
+        参数和config.yaml中的server配置相同，参数优先。
+        """
+        from dn.server import DNServer, server_options
+
+        options = server_options(config.server, bind=bind, **options)
+        registry.reset_directory()
+        DNServer(lambda: self.flaskapp, options,
+                 reloader=self.reload_views).run()
+
+    def reload_views(self):
+        """
+        重新导入view所在的模块并按新的代码创建app，返回新的wsgi app，
+        gunicorn的master收到SIGHUP时调用，之后fork出来的worker使用新的app。
+        """
+        reloader.reload(DNView.__subclasses__())
+        app = type(self).register_view_func()
+        for block, mapping, skiplist in self._mounts:
+            if isinstance(block, types.ModuleType):
+                # 模块重新导入过时使用新的模块
+                block = sys.modules.get(block.__name__, block)
+            app.mount(block, mapping, skiplist)
+        return app.flaskapp
@@ -0,0 +1,103 @@
+"""
+按rule限制同时处理的请求数。
+
+超过max_concurrency的请求进入等待队列，最多等待queue_timeout秒；队列已满或者
+等待超时时直接拒绝，由DNApp返回503和Retry-After，昂贵的接口过载时不会占满
+所有worker，其他接口不受影响。限制针对单个worker进程，对threads和gevent
+worker有意义，sync worker每个进程同时只处理一个请求。
+"""
+import threading
+import time
+
+from dn.common.metrics import registry
+
+REJECT_QUEUE_FULL = 'queue_full'
+REJECT_TIMEOUT = 'timeout'
+
+
+class ConcurrencyLimiter(object):
+    def __init__(self, rule, max_concurrency, max_queue=0, queue_timeout=1.0):
+        self.rule = rule
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        self._labels = {'rule': rule}
+
+    def acquire(self):
+        """获得执行许可时返回None，被拒绝时返回原因。"""
+        with self._cond:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return None
+            if self.waiting >= self.max_queue:
+                return REJECT_QUEUE_FULL
+            self.waiting += 1
+            registry.add_gauge('dn_admission_queue_depth', self._labels, 1)
+            try:
+                deadline = time.time() + self.queue_timeout
+                while self.active >= self.max_concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return REJECT_TIMEOUT
+                    self._cond.wait(remaining)
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+                registry.add_gauge('dn_admission_queue_depth', self._labels, -1)
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class AdmissionControl(object):
+    def __init__(self):
+        self.configure()
+
+    def configure(self, enabled=True, default=None, rules=None, retry_after=1,
+                  **kwargs):
+        self.enabled = enabled
+        self.default = default or {}
+        self.rules = rules or {}
+        self.retry_after = retry_after
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, rule):
+        """rule没有配置限制时返回None。"""
+        try:
+            return self._limiters[rule]
+        except KeyError:
+            pass
+        with self._lock:
+            if rule not in self._limiters:
+                conf = self.rules.get(rule)
+                if conf is None:
+                    conf = self.default
+                limiter = None
+                if conf and conf.get('max_concurrency'):
+                    limiter = ConcurrencyLimiter(rule, **conf)
+                self._limiters[rule] = limiter
+            return self._limiters[rule]
+
+    def acquire(self, rule):
+        """返回(limiter, 拒绝原因)，请求结束时调用limiter.release()。"""
+        if not self.enabled:
+            return None, None
+        limiter = self.limiter(rule)
+        if limiter is None:
+            return None, None
+        reason = limiter.acquire()
+        if reason is not None:
+            registry.inc('dn_admission_rejected_total',
+                         {'rule': rule, 'reason': reason})
+            return None, reason
+        return limiter, None
+
+
+admission = AdmissionControl()
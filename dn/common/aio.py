@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def _start_native_thread(target):
+    from gevent import monkey
+    monkey.get_original('_thread', 'start_new_thread')(target, ())
+
+
+class _NativeExecutor(ThreadPoolExecutor):
+    """
+    gevent打过补丁时threading中的线程是greenlet，只会在创建它的线程的hub中运行，
+    事件循环线程的hub不会运行，run_in_executor（例如getaddrinfo）会一直等待。
+    每个任务使用一个真正的线程执行。
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        from concurrent.futures import Future
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        _start_native_thread(run)
+        return future
+
+
+def _new_loop(gevent):
+    if not gevent:
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever,
+                                  name='dn-asyncio-loop')
+        thread.daemon = True
+        thread.start()
+        return loop
+    # gevent的selectors在没有其他greenlet的线程中会抛出LoopExit，
+    # 事件循环在真正的线程中使用原始的selector
+    from gevent import monkey
+    selector = monkey.get_original('selectors', 'DefaultSelector')()
+    loop = asyncio.SelectorEventLoop(selector)
+    loop.set_default_executor(_NativeExecutor(1))
+    _start_native_thread(loop.run_forever)
+    return loop
+
+
+def get_event_loop():
+    """每个进程一个事件循环，运行在后台线程中，fork之后重新创建。
+
+    gevent打过补丁的worker中同样只有一个事件循环，运行在真正的线程中，
+    所有greenlet的协程都提交给它，请求之间的IO等待可以重叠。
+    """
+    global _loop, _loop_pid
+    pid = os.getpid()
+    if _loop is None or _loop_pid != pid:
+        with _loop_lock:
+            if _loop is None or _loop_pid != pid:
+                _loop, _loop_pid = _new_loop(_gevent_patched()), pid
+    return _loop
+
+
+def _run_in_greenlet(coro, timeout, context):
+    """
+    把协程提交给事件循环线程，当前greenlet等待结果，不阻塞hub中的其他greenlet。
+    事件循环线程通过hub的async watcher唤醒等待的greenlet，watcher.send()
+    可以从其他线程调用。
+    """
+    from gevent import Timeout, get_hub
+    from gevent.event import AsyncResult
+
+    loop = get_event_loop()
+    watcher = get_hub().loop.async_()
+    result = AsyncResult()
+    # submit在事件循环线程中写入，wakeup在任务完成之后才会读取
+    task = []
+
+    def submit():
+        task.append(loop.create_task(coro))
+        task[0].add_done_callback(lambda _: watcher.send())
+
+    def cancel():
+        # call_soon_threadsafe按顺序执行，这时submit已经执行过
+        task[0].cancel()
+
+    def wakeup():
+        if task[0].cancelled():
+            result.set_exception(asyncio.CancelledError())
+        elif task[0].exception() is not None:
+            result.set_exception(task[0].exception())
+        else:
+            result.set(task[0].result())
+
+    watcher.start(wakeup)
+    try:
+        # call_soon_threadsafe复制调用时的context，任务在这份context中创建和执行
+        context.run(loop.call_soon_threadsafe, submit)
+        try:
+            return result.get(timeout=timeout)
+        except Timeout:
+            loop.call_soon_threadsafe(cancel)
+            raise FuturesTimeoutError()
+    finally:
+        watcher.stop()
+        watcher.close()
+
+
+def run_coroutine(coro, timeout=None, context=None):
+    """在后台事件循环中执行协程，阻塞当前线程直到得到结果。
+
+    协程在context（默认为当前context的副本）中执行，ContextVar与调用者一致。
+    gevent打过补丁的worker中只阻塞当前greenlet，同一个worker中的其他请求照常
+    执行，它们的协程在同一个事件循环中并发等待。
+    """
+    if context is None:
+        context = contextvars.copy_context()
+    if _gevent_patched():
+        return _run_in_greenlet(coro, timeout, context)
+    future = context.run(asyncio.run_coroutine_threadsafe, coro,
+                         get_event_loop())
+    return future.result(timeout)
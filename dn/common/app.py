@@ -4,8 +4,8 @@ import sys
 
 # from dn.common import log
 # from dn.common import sqldb
-# from dn.common.globals import config, config_object
-# from dn.common.yamlconfig import YamlConfig
+from dn.common.globals import config_object
+from dn.common.yamlconfig import YamlConfig
 
 
 class DNEnv(object):
@@ -15,7 +15,7 @@ class DNEnv(object):
             self.config_file = config_file
         else:
             self.config_file = os.path.join(self.root_path, config_file)
-        # config_object.set_target_object(YamlConfig(self.config_file).preload())
+        self.init_config()
         # self.init_log()
         # self.init_sqldb()
         self.init_app()
@@ -44,6 +44,16 @@ class DNEnv(object):
 
         return os.path.dirname(os.path.abspath(filepath))
 
+    def init_config(self):
+        name, ext = os.path.splitext(self.config_file)
+        if os.path.exists(self.config_file) \
+                or os.path.exists('%s.template%s' % (name, ext)):
+            conf = YamlConfig(self.config_file).preload()
+        else:
+            # 没有配置文件时各项配置取默认值
+            conf = YamlConfig()
+        config_object.set_target_object(conf)
+
     # def init_log(self):
     #     log_config = config.log
     #     name = config.appname
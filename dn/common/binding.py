@@ -0,0 +1,337 @@
+"""
+DNView方法的参数绑定。
+
+view方法用类型注解或者 @params 声明参数，注册路由时为每个view生成一个专门的
+绑定函数：按声明的顺序逐个取值、转换类型、检查范围，生成的代码中没有按类型
+的分支和对参数的循环，缺少参数或者格式不对时抛出ParameterError(400)。
+
+    class UserView(DNView):
+        def user_list(self, page: int = 1, tags: List[str] = None, active: bool = True):
+            ...
+
+        @params(limit=Param(int, min=1, max=100), order=Param(str, choices=['asc', 'desc']))
+        def user_search(self, keyword: str, limit=20, order='asc'):
+            ...
+
+只绑定有类型注解或者在 @params 中声明的参数，其他参数仍然使用默认值。
+"""
+import inspect
+import typing
+
+from werkzeug.datastructures import (CombinedMultiDict, ImmutableMultiDict,
+                                     MultiDict)
+
+from dn.common.exceptions import ParameterError
+
+_MISSING = object()
+REQUIRED = _MISSING
+
+_TRUE = frozenset(['1', 'true', 'yes', 'on'])
+_FALSE = frozenset(['0', 'false', 'no', 'off'])
+
+
+class Param(object):
+    """
+    参数的类型和约束，min、max对数字是取值范围，对字符串和列表是长度，
+    alias为请求数据中的字段名（默认与参数名相同）。
+    """
+
+    def __init__(self, type=None, default=REQUIRED, min=None, max=None,
+                 choices=None, alias=None):
+        self.type = type
+        self.default = default
+        self.min = min
+        self.max = max
+        self.choices = choices
+        self.alias = alias
+
+
+def to_int(v):
+    if type(v) is int:
+        return v
+    if isinstance(v, str):
+        return int(v)
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    raise TypeError()
+
+
+def to_float(v):
+    if type(v) is float or type(v) is int:
+        return float(v)
+    if isinstance(v, str):
+        return float(v)
+    raise TypeError()
+
+
+def to_str(v):
+    if isinstance(v, str):
+        return v
+    if type(v) is int or type(v) is float:
+        return str(v)
+    raise TypeError()
+
+
+def to_bool(v):
+    if v is True or v is False:
+        return v
+    if isinstance(v, str):
+        s = v.lower()
+        if s in _TRUE:
+            return True
+        if s in _FALSE:
+            return False
+    elif type(v) is int and v in (0, 1):
+        return bool(v)
+    raise ValueError()
+
+
+def to_list(v):
+    if isinstance(v, list):
+        return v
+    if isinstance(v, tuple):
+        return list(v)
+    raise TypeError()
+
+
+def to_dict(v):
+    if isinstance(v, dict):
+        return v
+    raise TypeError()
+
+
+def to_any(v):
+    return v
+
+
+CONVERTERS = {
+    int: to_int,
+    float: to_float,
+    str: to_str,
+    bool: to_bool,
+    list: to_list,
+    dict: to_dict,
+}
+
+
+# 生成代码时内联的快速路径：值已经是目标类型时不调用转换函数，
+# 字符串直接调用内置的int、float
+INLINE = {
+    to_int: '%(v)s if type(%(v)s) is int else int(%(v)s) '
+            'if type(%(v)s) is str else _c%(i)d(%(v)s)',
+    to_float: '%(v)s if type(%(v)s) is float else float(%(v)s) '
+              'if type(%(v)s) is str else _c%(i)d(%(v)s)',
+    to_str: '%(v)s if type(%(v)s) is str else _c%(i)d(%(v)s)',
+    to_bool: '%(v)s if %(v)s is True or %(v)s is False else _c%(i)d(%(v)s)',
+    to_list: '%(v)s if type(%(v)s) is list else _c%(i)d(%(v)s)',
+    to_dict: '%(v)s if type(%(v)s) is dict else _c%(i)d(%(v)s)',
+}
+
+# 列表元素的类型，元素已经是该类型时不调用转换函数
+ITEM_TYPES = {to_int: int, to_float: float, to_str: str}
+
+
+def list_of(convert):
+    def to_list_of(v):
+        return [convert(item) for item in to_list(v)]
+    to_list_of.item = convert
+    return to_list_of
+
+
+def type_name(tp):
+    return getattr(tp, '__name__', None) or str(tp).replace('typing.', '')
+
+
+def type_origin(tp):
+    origin = getattr(tp, '__origin__', None)
+    # python3.6中List[int]的__origin__是typing.List，3.7之后是list
+    if tp is typing.List or origin is typing.List:
+        return list
+    if tp is typing.Dict or origin is typing.Dict:
+        return dict
+    return origin
+
+
+def type_args(tp):
+    # 没有参数的typing.List在3.7之后的__args__是TypeVar
+    return [a for a in getattr(tp, '__args__', None) or ()
+            if not isinstance(a, typing.TypeVar)]
+
+
+def resolve(tp):
+    """返回(转换函数, 是否是列表, 是否可以为None, 类型名称)。"""
+    if tp is None or tp is inspect.Parameter.empty or tp is typing.Any:
+        return to_any, False, True, 'any'
+    nullable = False
+    origin = type_origin(tp)
+    if origin is typing.Union:
+        args = [a for a in type_args(tp) if a is not type(None)]
+        nullable = len(args) < len(type_args(tp))
+        if len(args) != 1:
+            raise TypeError('unsupported parameter type: %s' % tp)
+        tp = args[0]
+        origin = type_origin(tp)
+    if tp is list or origin is list:
+        args = type_args(tp)
+        if args and args[0] is not typing.Any:
+            item_convert, _, _, item_name = resolve(args[0])
+            return (list_of(item_convert), True, nullable,
+                    'list of %s' % item_name)
+        return to_list, True, nullable, 'list'
+    if tp is dict or origin is dict:
+        return to_dict, False, nullable, 'dict'
+    convert = CONVERTERS.get(tp)
+    if convert is None:
+        if not callable(tp):
+            raise TypeError('unsupported parameter type: %s' % tp)
+        # 其他类型直接调用，例如Decimal、自定义的类型
+        convert = tp
+    return convert, False, nullable, type_name(tp)
+
+
+def declared_params(func):
+    """
+    返回[(参数名, Param, 方法是否有默认值)]，
+    只包括有类型注解或者在@params中声明的参数。
+    """
+    schema = getattr(func, '_dn_params', None) or {}
+    try:
+        hints = typing.get_type_hints(func)
+    except Exception:
+        hints = getattr(func, '__annotations__', {})
+    declared = []
+    for name, parameter in inspect.signature(func).parameters.items():
+        if parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD):
+            continue
+        spec = schema.get(name)
+        if spec is None and name not in hints:
+            continue
+        if not isinstance(spec, Param):
+            spec = Param(spec)
+        if spec.type is None:
+            spec = Param(hints.get(name), spec.default, spec.min, spec.max,
+                         spec.choices, spec.alias)
+        declared.append((name, spec, parameter.default))
+    unknown = set(schema) - set(name for name, _, _ in declared)
+    if unknown:
+        raise TypeError('%s has no parameter %s'
+                        % (func.__qualname__, ', '.join(sorted(unknown))))
+    return declared
+
+
+def compile_binder(func):
+    """
+    把声明的参数编译成一个函数binder(data)，返回传给view的kwargs。
+    没有声明参数时返回None，这样的view不做任何额外的处理。
+    """
+    declared = declared_params(func)
+    if not declared:
+        return None
+    namespace = {'_M': _MISSING, '_E': ParameterError, '_EMPTY': {},
+                 '_dget': dict.get,
+                 '_Combined': CombinedMultiDict,
+                 '_MultiDicts': (MultiDict, ImmutableMultiDict)}
+    fields = [(name, spec, default) + resolve(spec.type)
+              for name, spec, default in declared]
+    # 先取出所有字段：json为dict；query string和form为werkzeug的MultiDict，
+    # 它的get、getlist都是python实现的，没有这个字段时还要抛出并捕获KeyError，
+    # 这里直接读取MultiDict内部每个字段的值列表
+    lines = ['def binder(data):',
+             '    if type(data) is _Combined:',
+             '        # request.values，GET请求的form、POST请求的query string通常为空',
+             '        dicts = [d for d in data.dicts if d]',
+             '        if len(dicts) < 2:',
+             '            data = dicts[0] if dicts else _EMPTY',
+             '    if type(data) is dict:',
+             '        get = data.get']
+    multi = ['    elif type(data) in _MultiDicts:']
+    other = ['    else:',
+             "        get = getattr(data, 'get', None)",
+             '        if get is None:',
+             "            raise _E(400, 'invalid request data: expected object')"]
+    if any(is_list for _, _, _, _, is_list, _, _ in fields):
+        # 列表为同名的多个字段
+        other.append("        getlist = getattr(data, 'getlist', None) or get")
+    for i, (name, spec, _, _, is_list, _, _) in enumerate(fields):
+        namespace['_k%d' % i] = spec.alias or name
+        lines.append('        v%d = get(_k%d, _M)' % (i, i))
+        multi.append('        v%d = _dget(data, _k%d)' % (i, i))
+        multi.append('        v%d = %s if v%d else _M'
+                     % (i, ('list(v%d)' if is_list else 'v%d[0]') % i, i))
+        other.append('        v%d = %s(_k%d) if _k%d in data else _M'
+                     % (i, 'getlist' if is_list else 'get', i, i))
+    lines += multi + other
+    for i, (name, spec, default, convert, is_list, nullable,
+            expected) in enumerate(fields):
+        v = 'v%d' % i
+        key = spec.alias or name
+        namespace['_c%d' % i] = convert
+        lines.append('    if %s is _M:' % v)
+        if spec.default is not REQUIRED:
+            default = spec.default
+        if default is inspect.Parameter.empty:
+            lines.append('        raise _E(400, %r)'
+                         % ('missing parameter: %s' % key))
+        else:
+            namespace['_d%d' % i] = default
+            lines.append('        %s = _d%d' % (v, i))
+        if nullable or default is None:
+            lines.append('    elif %s is None:' % v)
+            lines.append('        pass')
+        if convert is to_any and spec.min is None and spec.max is None \
+                and spec.choices is None:
+            continue
+        lines.append('    else:')
+        item = getattr(convert, 'item', None)
+        if convert is not to_any:
+            lines.append('        try:')
+            if item in ITEM_TYPES:
+                # 所有元素都已经是目标类型时不复制列表
+                namespace['_t%d' % i] = ITEM_TYPES[item]
+                lines.append('            if type(%s) is list:' % v)
+                lines.append('                for x in %s:' % v)
+                lines.append('                    if type(x) is not _t%d:' % i)
+                lines.append('                        %s = _c%d(%s)'
+                             % (v, i, v))
+                lines.append('                        break')
+                lines.append('            else:')
+                lines.append('                %s = _c%d(%s)' % (v, i, v))
+            elif convert in INLINE:
+                lines.append('            %s = %s' % (
+                    v, INLINE[convert] % {'v': v, 'i': i}))
+            else:
+                lines.append('            %s = _c%d(%s)' % (v, i, v))
+            lines.append('        except (TypeError, ValueError, '
+                         'ArithmeticError):')
+            lines.append('            raise _E(400, %r)' % (
+                'invalid parameter %s: expected %s' % (key, expected)))
+        measure = 'len(%s)' % v if convert in (to_str, to_list) or is_list \
+            else v
+        if spec.min is not None:
+            namespace['_min%d' % i] = spec.min
+            lines.append('        if %s < _min%d:' % (measure, i))
+            lines.append('            raise _E(400, %r)' % (
+                'invalid parameter %s: must not be less than %s'
+                % (key, spec.min)))
+        if spec.max is not None:
+            namespace['_max%d' % i] = spec.max
+            lines.append('        if %s > _max%d:' % (measure, i))
+            lines.append('            raise _E(400, %r)' % (
+                'invalid parameter %s: must not be greater than %s'
+                % (key, spec.max)))
+        if spec.choices is not None:
+            namespace['_choices%d' % i] = frozenset(spec.choices)
+            lines.append('        if %s not in _choices%d:' % (v, i))
+            lines.append('            raise _E(400, %r)' % (
+                'invalid parameter %s: must be one of %s'
+                % (key, ', '.join(map(str, spec.choices)))))
+    # 没有传入的参数也用默认值填上，一次构造kwargs
+    lines.append('    return {%s}' % ', '.join(
+        '%r: v%d' % (name, i) for i, (name, _, _, _, _, _, _)
+        in enumerate(fields)))
+    source = '\n'.join(lines)
+    code = compile(source, '<binder %s>' % func.__qualname__, 'exec')
+    exec(code, namespace)
+    binder = namespace['binder']
+    binder.source = source
+    return binder
@@ -0,0 +1,178 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from dn.common import log
+
+logger = log.get_logger('common.cache')
+
+
+def normalize_request_data(data):
+    """把请求数据转换成稳定的字符串，key的顺序不影响结果。"""
+    if data is None:
+        return ''
+    if hasattr(data, 'to_dict'):
+        # request.values 等 MultiDict
+        data = data.to_dict(flat=False)
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def request_data_digest(data):
+    return hashlib.sha1(
+        normalize_request_data(data).encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """进程内缓存，超过maxsize时淘汰最久未使用的条目，条目超过ttl秒后失效。"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, prefix=None):
+        expires = time.time() + (ttl or self.ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache(object):
+    """
+    基于RedisStore的共享缓存，多个进程和机器共用。
+    每个前缀下的key记录在一个set中，按前缀失效时不需要scan。
+    """
+
+    def __init__(self, client, key_prefix='dn:cache:', ttl=60):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+
+    def _index_key(self, prefix):
+        return '%sindex:%s' % (self.key_prefix, prefix)
+
+    def get(self, key):
+        return self.client.get(self.key_prefix + key)
+
+    def set(self, key, value, ttl=None, prefix=None):
+        ttl = ttl or self.ttl
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self.key_prefix + key, value, ex=ttl)
+        if prefix is not None:
+            index_key = self._index_key(prefix)
+            pipe.sadd(index_key, self.key_prefix + key)
+            pipe.expire(index_key, ttl)
+        pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(self.key_prefix + key)
+
+    def delete_prefix(self, prefix):
+        index_key = self._index_key(prefix)
+        keys = self.client.smembers(index_key)
+        self.client.delete(index_key, *keys)
+
+
+class ResponseCache(object):
+    """
+    缓存view序列化之后的响应，key为rule名称加上规范化之后的请求数据。
+    """
+
+    def __init__(self, backend=None, ttl=60):
+        self.backend = backend or LRUCache(ttl=ttl)
+        self.ttl = ttl
+        self.views = {}
+        self._stats = collections.defaultdict(lambda: [0, 0])
+        self._stats_lock = threading.Lock()
+
+    def configure(self, backend='memory', maxsize=1024, ttl=60, redis=None,
+                  key_prefix='dn:cache:', views=None, **kwargs):
+        if backend == 'redis':
+            from dn.common.globals import config
+            from dn.common.wrappers import RedisStore
+            url = redis or (config.redis.get('instances') or [None])[0]
+            if not url:
+                raise RuntimeError('redis url should be set for redis cache')
+            self.backend = RedisCache(RedisStore.create(url), key_prefix, ttl)
+        elif backend == 'memory':
+            self.backend = LRUCache(maxsize, ttl)
+        else:
+            raise RuntimeError('unknown cache backend: %s' % backend)
+        self.ttl = ttl
+        self.views = views or {}
+
+    def key(self, rule, data):
+        return '%s:%s' % (rule, request_data_digest(data))
+
+    def _count(self, rule, hit):
+        with self._stats_lock:
+            self._stats[rule][0 if hit else 1] += 1
+
+    def get(self, rule, data):
+        """返回(mimetype, body)，没有缓存时返回None。"""
+        try:
+            value = self.backend.get(self.key(rule, data))
+        except Exception as e:
+            logger.error('response cache get failed', rule, str(e))
+            value = None
+        self._count(rule, value is not None)
+        if value is None:
+            return None
+        mimetype, body = value.split(b'\n', 1)
+        return mimetype.decode('utf-8'), body
+
+    def set(self, rule, data, mimetype, body, ttl=None):
+        value = mimetype.encode('utf-8') + b'\n' + body
+        try:
+            self.backend.set(self.key(rule, data), value, ttl, prefix=rule + ':')
+        except Exception as e:
+            logger.error('response cache set failed', rule, str(e))
+
+    def invalidate(self, rule, data=None):
+        """失效rule下请求数据为data的缓存，data为None时失效该rule下所有的缓存。"""
+        if data is None:
+            self.backend.delete_prefix(rule + ':')
+        else:
+            self.backend.delete(self.key(rule, data))
+
+    def metrics(self):
+        for rule, stat in self.stats().items():
+            yield 'dn_cache_hits_total', {'rule': rule}, stat['hits']
+            yield 'dn_cache_misses_total', {'rule': rule}, stat['misses']
+
+    def stats(self):
+        with self._stats_lock:
+            return {rule: {'hits': hits, 'misses': misses}
+                    for rule, (hits, misses) in self._stats.items()}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,91 @@
+import zlib
+
+from dn.common import log
+
+logger = log.get_logger('common.compress')
+
+DEFAULT_MIMETYPES = [
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml',
+    'application/json', 'application/x-ndjson',
+    'application/javascript', 'application/xml',
+]
+
+# gzip 和 deflate(zlib格式) 对应的wbits
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+class Compressor(object):
+    """
+    按Accept-Encoding压缩响应体，小于min_size的响应和不在mimetypes中的类型
+    （图片、压缩包等本身已经压缩过的内容）不压缩。
+    """
+
+    def __init__(self, enabled=True, min_size=500, level=6, mimetypes=None):
+        self.configure(enabled, min_size, level, mimetypes)
+
+    def configure(self, enabled=True, min_size=500, level=6, mimetypes=None,
+                  **kwargs):
+        if not 1 <= level <= 9:
+            raise RuntimeError('compress level should be in 1~9: %s' % level)
+        self.enabled = enabled
+        self.min_size = min_size
+        self.level = level
+        self.mimetypes = set(mimetypes or DEFAULT_MIMETYPES)
+
+    def negotiate(self, request):
+        accept = request.accept_encodings
+        for encoding in ('gzip', 'deflate'):
+            if accept[encoding] > 0:
+                return encoding
+        return None
+
+    def compressobj(self, encoding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+
+    def compress(self, data, encoding):
+        obj = self.compressobj(encoding)
+        return obj.compress(data) + obj.flush()
+
+    def iter_compress(self, iterable, encoding):
+        # 每个chunk都sync flush，流式输出时客户端可以及时解压出已经生成的数据
+        obj = self.compressobj(encoding)
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = obj.compress(chunk) + obj.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield obj.flush()
+
+    def compress_response(self, request, response):
+        if not self.enabled \
+                or response.status_code < 200 \
+                or response.status_code in (204, 304) \
+                or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers \
+                or response.mimetype not in self.mimetypes:
+            return response
+
+        encoding = self.negotiate(request)
+        response.vary.add('Accept-Encoding')
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self.iter_compress(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(self.compress(data, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        # 压缩之后的内容与原内容不再逐字节相同，强ETag改为弱ETag
+        tag, weak = response.get_etag()
+        if tag and not weak:
+            response.set_etag(tag, weak=True)
+        return response
+
+
+compressor = Compressor()
@@ -0,0 +1,134 @@
+"""
+跨域(CORS)。
+
+- origins为允许的来源列表，'*'表示允许任何来源（返回请求的来源，可以携带cookie），
+  也可以使用通配符，例如 https://*.example.com
+- 每个来源对应的响应头只计算一次，之后直接使用缓存
+- 浏览器的预检请求(OPTIONS)由CORSMiddleware在路由之前直接返回，
+  并带上Access-Control-Max-Age，浏览器在max_age秒内不再重复预检
+"""
+import fnmatch
+import threading
+from urllib.parse import urlparse
+
+
+class CORSPolicy(object):
+    def __init__(self):
+        self.configure()
+
+    def configure(self, enabled=True, origins=None, allow_credentials=True,
+                  allow_headers=None, allow_methods=None, expose_headers=None,
+                  max_age=86400, cache_size=1024, **kwargs):
+        self.enabled = enabled
+        origins = list(origins or ['*'])
+        self.any_origin = '*' in origins
+        self.origins = set(o for o in origins if '*' not in o)
+        self.patterns = [o for o in origins if '*' in o and o != '*']
+        self.allow_credentials = allow_credentials
+        self.allow_headers = ', '.join(
+            allow_headers or ['Authorization', 'content-type'])
+        self.allow_methods = ', '.join(
+            allow_methods or ['GET', 'POST', 'DELETE'])
+        self.expose_headers = ', '.join(expose_headers or [])
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self._headers = {}
+        self._preflight_headers = {}
+        self._lock = threading.Lock()
+
+    def origin_of(self, environ):
+        origin = environ.get('HTTP_ORIGIN')
+        if origin:
+            return origin
+        # 兼容以前的做法，没有Origin时使用Referer的scheme和域名
+        referrer = environ.get('HTTP_REFERER')
+        if referrer:
+            matches = urlparse(referrer)
+            return matches.scheme + '://' + matches.netloc
+        return None
+
+    def allowed(self, origin):
+        if self.any_origin or origin in self.origins:
+            return True
+        return any(fnmatch.fnmatchcase(origin, p) for p in self.patterns)
+
+    def _build(self, origin):
+        if origin is None:
+            # 不是跨域请求
+            allow_origin = '*'
+        elif self.allowed(origin):
+            allow_origin = origin
+        else:
+            return None
+        headers = [('Access-Control-Allow-Origin', allow_origin)]
+        if self.allow_credentials:
+            headers.append(('Access-Control-Allow-Credentials', 'true'))
+        headers.append(('Access-Control-Allow-Headers', self.allow_headers))
+        headers.append(('Access-Control-Allow-Methods', self.allow_methods))
+        if self.expose_headers:
+            headers.append(('Access-Control-Expose-Headers', self.expose_headers))
+        return headers
+
+    def _cached(self, cache, origin, build):
+        try:
+            return cache[origin]
+        except KeyError:
+            pass
+        headers = build(origin)
+        with self._lock:
+            if len(cache) >= self.cache_size:
+                # 来源很多时整个清空，避免缓存无限增长
+                cache.clear()
+            cache[origin] = headers
+        return headers
+
+    def headers(self, origin):
+        """普通响应的CORS头，来源不允许时返回None。"""
+        return self._cached(self._headers, origin, self._build)
+
+    def preflight_headers(self, origin):
+        def build(origin):
+            headers = self._build(origin)
+            if headers is not None and self.max_age:
+                headers = headers + [
+                    ('Access-Control-Max-Age', str(self.max_age))]
+            return headers
+        return self._cached(self._preflight_headers, origin, build)
+
+    def apply(self, response, environ):
+        if not self.enabled:
+            return response
+        origin = self.origin_of(environ)
+        headers = self.headers(origin)
+        if headers is not None:
+            header = response.headers
+            for key, value in headers:
+                header[key] = value
+        if origin is not None:
+            response.vary.add('Origin')
+        return response
+
+
+class CORSMiddleware(object):
+    """在路由和整个请求处理流程之前直接响应预检请求。"""
+
+    def __init__(self, wsgi_app, policy):
+        self.wsgi_app = wsgi_app
+        self.policy = policy
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'OPTIONS' \
+                and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ \
+                and self.policy.enabled:
+            headers = self.policy.preflight_headers(
+                self.policy.origin_of(environ))
+            if headers is None:
+                start_response('403 Forbidden', [('Content-Length', '0')])
+            else:
+                start_response('204 No Content', headers + [
+                    ('Content-Length', '0'), ('Vary', 'Origin')])
+            return [b'']
+        return self.wsgi_app(environ, start_response)
+
+
+cors = CORSPolicy()
@@ -0,0 +1,76 @@
+"""
+异常日志的去重和限流。
+
+同一个位置反复抛出的异常（类型和整条调用链上每一层的文件、函数、行号都相同，
+包括__cause__、__context__链上的异常）在window秒内只格式化并记录一次traceback，
+其余的只计数，下一次记录时带上期间省略的次数。计算签名只需要遍历traceback的
+frame，不需要格式化。
+"""
+import threading
+import time
+
+
+MAX_CHAIN = 8
+
+
+def _frames(tb):
+    frames = []
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        frames.append((code.co_filename, code.co_name, tb.tb_lineno))
+        tb = tb.tb_next
+    return tuple(frames)
+
+
+def signature(error):
+    """
+    异常的类型和traceback上每一层的(文件, 函数, 行号)，同一个底层函数从不同的
+    调用路径抛出的异常签名不同，会分别记录traceback。
+    """
+    key = []
+    seen = set()
+    while error is not None and id(error) not in seen \
+            and len(key) < MAX_CHAIN:
+        seen.add(id(error))
+        key.append((error.__class__.__name__, _frames(error.__traceback__)))
+        if error.__cause__ is not None:
+            error = error.__cause__
+        elif not error.__suppress_context__:
+            error = error.__context__
+        else:
+            error = None
+    return tuple(key)
+
+
+class TracebackLimiter(object):
+    def __init__(self, window=60, max_signatures=1000):
+        self.configure(window, max_signatures)
+
+    def configure(self, window=60, max_signatures=1000, **kwargs):
+        self.window = window
+        self.max_signatures = max_signatures
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def check(self, error):
+        """
+        需要记录traceback时返回上次记录之后省略的次数，
+        window内已经记录过时返回None。
+        """
+        if not self.window:
+            return 0
+        key = signature(error)
+        now = time.time()
+        with self._lock:
+            item = self._seen.get(key)
+            if item is not None and now - item[0] < self.window:
+                item[1] += 1
+                return None
+            suppressed = item[1] if item is not None else 0
+            if item is None and len(self._seen) >= self.max_signatures:
+                self._seen.clear()
+            self._seen[key] = [now, 0]
+            return suppressed
+
+
+traceback_limiter = TracebackLimiter()
@@ -21,6 +21,24 @@ class SessionError(AppBaseException):
     pass
 
 
+class OverloadedError(AppBaseException):
+    """服务过载，拒绝处理请求，retry_after秒之后可以重试。"""
+
+    def __init__(self, description='Service Overloaded', retry_after=1,
+                 data=None, extra_info=None):
+        super(OverloadedError, self).__init__(503, description, data, extra_info)
+        self.retry_after = retry_after
+
+
+class RateLimitedError(AppBaseException):
+    """请求频率超过限制，retry_after秒之后可以重试。"""
+
+    def __init__(self, description='Too Many Requests', retry_after=1,
+                 data=None, extra_info=None):
+        super(RateLimitedError, self).__init__(429, description, data, extra_info)
+        self.retry_after = retry_after
+
+
 class ConnectionError(Exception):
     """Failed to connect to the broker."""
     pass
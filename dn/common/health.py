@@ -0,0 +1,158 @@
+"""
+依赖的健康检查。
+
+后台线程每interval秒检查一次config.yaml中配置的每个sqldb和redis实例，
+/health/ready 只读取缓存的结果，检查本身不增加请求的延迟，也不随请求量增加
+数据库的负担。同时报告连接池的使用率（已经借出的连接数/连接池的容量）。
+"""
+import os
+import threading
+import time
+
+from dn.common import log, sqldb
+from dn.common.metrics import registry
+from dn.common.shutdown import shutdown
+
+logger = log.get_logger('common.health')
+
+
+def sqldb_pool_stats(engine):
+    pool = engine.pool
+    try:
+        size = pool.size()
+        checked_out = pool.checkedout()
+        capacity = size + max(pool._max_overflow, 0)
+    except AttributeError:
+        # NullPool、StaticPool等没有容量限制
+        return None
+    return {'size': size, 'checked_out': checked_out, 'capacity': capacity,
+            'saturation': round(checked_out / capacity, 3) if capacity else 0}
+
+
+def redis_pool_stats(client):
+    pool = client.connection_pool
+    capacity = getattr(pool, 'max_connections', None)
+    in_use = len(getattr(pool, '_in_use_connections', ()))
+    if not capacity or capacity >= 2 ** 31 - 1:
+        # 没有限制连接数
+        return {'in_use': in_use}
+    return {'in_use': in_use, 'capacity': capacity,
+            'saturation': round(in_use / capacity, 3)}
+
+
+def probe_sqldb(name):
+    from sqlalchemy import text
+    engine = sqldb.get_engine(name)
+    stats = sqldb_pool_stats(engine)
+    if stats and stats['checked_out'] >= stats['capacity']:
+        # 连接池已经用完，不再借连接，否则检查线程会一直等待
+        return stats
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    return sqldb_pool_stats(engine)
+
+
+def probe_redis(client):
+    client.ping()
+    return redis_pool_stats(client)
+
+
+class HealthChecker(object):
+    def __init__(self):
+        self.configure()
+
+    def configure(self, interval=5, max_saturation=None, sqldb=True,
+                  redis=True, **kwargs):
+        self.interval = interval
+        self.max_saturation = max_saturation
+        self.check_sqldb = sqldb
+        self.check_redis = redis
+        self._results = None
+        self._checked_at = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def probes(self):
+        from dn.common.globals import config
+        probes = []
+        if self.check_sqldb:
+            for name in config.sqldb:
+                probes.append(('sqldb:%s' % name,
+                               lambda name=name: probe_sqldb(name)))
+        if self.check_redis and config.redis.get('instances'):
+            for i, client in enumerate(config.redis_instances):
+                probes.append(('redis:%d' % i,
+                               lambda client=client: probe_redis(client)))
+        return probes
+
+    def check(self):
+        results = {}
+        for name, probe in self.probes():
+            started = time.time()
+            try:
+                pool = probe()
+                result = {'ok': True}
+            except Exception as e:
+                pool = None
+                result = {'ok': False, 'error': '%s: %s' % (
+                    e.__class__.__name__, e)}
+            result['latency_ms'] = round((time.time() - started) * 1000, 1)
+            if pool:
+                result['pool'] = pool
+                saturation = pool.get('saturation')
+                if saturation is not None:
+                    registry.set_gauge('dn_pool_saturation', {'name': name},
+                                       saturation)
+                    if self.max_saturation is not None \
+                            and saturation >= self.max_saturation:
+                        result['ok'] = False
+                        result['error'] = 'pool saturated'
+            registry.set_gauge('dn_dependency_up', {'name': name},
+                               1 if result['ok'] else 0)
+            results[name] = result
+        self._results = results
+        self._checked_at = time.time()
+        return results
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error('health check error', str(e))
+            time.sleep(self.interval)
+
+    def start(self):
+        """
+        启动后台检查线程。fork出来的worker中没有父进程的线程，gunicorn在
+        post_worker_init中启动；其他情况第一次查询时启动。第一次检查也在后台
+        执行，依赖很慢时不会阻塞 /health/ready，检查完成之前返回unavailable。
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._run, name='dn-health')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def status(self):
+        self.start()
+        results = self._results or {}
+        ready = all(r['ok'] for r in results.values())
+        age = time.time() - self._checked_at
+        if age > self.interval * 3:
+            # 检查线程卡住（例如连接没有超时），结果已经不可信
+            ready = False
+        if shutdown.draining:
+            # 正在退出，让负载均衡先摘除这个worker
+            return {'status': 'draining', 'checked_at': self._checked_at,
+                    'age': round(age, 3), 'checks': results}
+        return {'status': 'ok' if ready else 'unavailable',
+                'checked_at': self._checked_at, 'age': round(age, 3),
+                'checks': results}
+
+
+health = HealthChecker()
@@ -0,0 +1,170 @@
+"""
+后台任务。
+
+标记为job的view被调用时立即返回任务id，view在有界的线程池中执行，
+pool为process时再转交给procpool执行，适合耗时较长的统计、聚合类接口。
+任务状态和序列化之后的结果保存在进程内存或者redis中，超过result_ttl秒后删除。
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from dn.common import log
+from dn.common.shutdown import shutdown
+from dn.common.tracing import tracer
+
+logger = log.get_logger('common.jobs')
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class MemoryJobStore(object):
+    """进程内保存任务，多个worker时查询请求可能落到别的worker上，需要使用redis。"""
+
+    def __init__(self, result_ttl=3600, max_jobs=1000):
+        self.result_ttl = result_ttl
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def save(self, job):
+        with self._lock:
+            self._jobs[job['id']] = (dict(job), time.time() + self.result_ttl)
+            self._jobs.move_to_end(job['id'])
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+    def get(self, job_id):
+        with self._lock:
+            item = self._jobs.get(job_id)
+            if item is None:
+                return None
+            job, expires = item
+            if expires < time.time():
+                del self._jobs[job_id]
+                return None
+            return dict(job)
+
+
+class RedisJobStore(object):
+    """基于RedisStore保存任务，多个worker和机器共用。"""
+
+    def __init__(self, client, key_prefix='dn:job:', result_ttl=3600):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.result_ttl = result_ttl
+
+    def save(self, job):
+        job = dict(job)
+        body = job.pop('body', None)
+        key = self.key_prefix + job['id']
+        mapping = {'meta': json.dumps(job)}
+        if body is not None:
+            mapping['body'] = body
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, self.result_ttl)
+        pipe.execute()
+
+    def get(self, job_id):
+        meta, body = self.client.hmget(self.key_prefix + job_id, 'meta', 'body')
+        if meta is None:
+            return None
+        job = json.loads(meta.decode('utf-8'))
+        if body is not None:
+            job['body'] = body
+        return job
+
+
+class JobRunner(object):
+    def __init__(self):
+        self.configure()
+
+    def configure(self, store='memory', redis=None, key_prefix='dn:job:',
+                  max_workers=4, max_pending=100,
+                  result_ttl=3600, max_jobs=1000, views=None, **kwargs):
+        if store == 'redis':
+            from dn.common.globals import config
+            from dn.common.wrappers import RedisStore
+            url = redis or (config.redis.get('instances') or [None])[0]
+            if not url:
+                raise RuntimeError('redis url should be set for job store')
+            self.store = RedisJobStore(RedisStore.create(url), key_prefix,
+                                       result_ttl)
+        elif store == 'memory':
+            self.store = MemoryJobStore(result_ttl, max_jobs)
+        else:
+            raise RuntimeError('unknown job store: %s' % store)
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.views = views or {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix='dn-job')
+        return self._executor
+
+    def submit(self, rule, func):
+        """
+        func在线程池中执行，返回(status, mimetype, body)。
+        排队的任务超过max_pending时返回None，由调用者拒绝请求。
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return None
+            self._pending += 1
+        job = {'id': uuid.uuid4().hex, 'rule': rule, 'status': PENDING,
+               'created': time.time()}
+        self.store.save(job)
+        submitted = dict(job)
+        # 排队和执行中的任务与请求一样，退出前等待它们结束
+        shutdown.enter()
+        try:
+            # 任务的日志带上提交它的请求的request id
+            self.executor.submit(tracer.thread_context().run, self.run, job,
+                                 func)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            shutdown.leave()
+            raise
+        return submitted
+
+    def run(self, job, func):
+        with self._lock:
+            self._pending -= 1
+        try:
+            self._run(job, func)
+        finally:
+            shutdown.leave()
+
+    def _run(self, job, func):
+        job.update(status=RUNNING, started=time.time())
+        self.store.save(job)
+        try:
+            code, mimetype, body = func()
+        except Exception as e:
+            # func自己处理view的异常并返回错误响应，这里只是兜底
+            logger.error('job %s of %s error' % (job['id'], job['rule']), str(e))
+            code, mimetype, body = 500, 'text/plain', str(e).encode('utf-8')
+        job.update(status=SUCCEEDED if code // 100 == 2 else FAILED,
+                   finished=time.time(), code=code, mimetype=mimetype,
+                   body=body)
+        self.store.save(job)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+
+jobs = JobRunner()
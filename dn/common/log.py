@@ -1,3 +1,4 @@
+import contextvars
 import logging
 import platform
 import traceback
@@ -16,6 +17,9 @@ _stdout = True
 _root_logger_name = 'noapp'
 _disabled_logger = []
 
+# 当前请求的request id，由tracing在请求开始时设置，每一行日志的最后带上 rid=<id>
+request_id = contextvars.ContextVar('dn_request_id', default=None)
+
 
 def get_logger(name=''):
     global logger_cache
@@ -182,6 +186,10 @@ class LLNLogger(logging.getLoggerClass()):
             if isinstance(msg, bytes):
                 msg = self.str_decode(msg)
 
+        rid = request_id.get()
+        if rid is not None:
+            msg = '%s|rid=%s' % (msg, rid)
+
         return super(LLNLogger, self).makeRecord(
             name, level, fn, lno, msg, args, exc_info, func, extra, sinfo)
 
@@ -0,0 +1,307 @@
+"""
+进程内的计数器、gauge和延迟直方图，以Prometheus文本格式输出。
+
+prefork部署时每个worker把自己的数据定期写到metrics目录下的<pid>.json，
+/metrics 读取目录中所有worker的数据汇总输出。已经退出的worker的计数器和直方图
+合并到_archive.json中保留，gauge只统计存活的worker。gauge默认在worker之间求和，
+describe时可以指定merge为max或者min，例如每个worker各自的连接池使用率。
+"""
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+ARCHIVE_FILE = '_archive.json'
+
+GAUGE_MERGE = {
+    'sum': lambda a, b: a + b,
+    'max': max,
+    'min': min,
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.extend(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in items)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+class Registry(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.directory = None
+        self.flush_interval = 1.0
+        self._helps = {}
+        self._gauge_merge = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._last_flush = 0
+
+    def configure(self, dir=None, flush_interval=1.0, buckets=None, **kwargs):
+        self.directory = dir
+        self.flush_interval = flush_interval
+        if buckets:
+            self.buckets = tuple(sorted(buckets))
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+    def describe(self, name, kind, text, merge='sum'):
+        if merge not in GAUGE_MERGE:
+            raise RuntimeError('unknown gauge merge: %s' % merge)
+        self._helps[name] = (kind, text)
+        if merge != 'sum':
+            self._gauge_merge[name] = merge
+
+    def register_collector(self, collector):
+        """collector()返回[(name, labels, value)]，输出时按counter处理。"""
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauge(self, name, labels=None, value=1):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def set_gauge(self, name, labels=None, value=0):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, labels=None, value=0):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = hist[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[n, list(l), v] for (n, l), v in self._counters.items()]
+            gauges = [[n, list(l), v] for (n, l), v in self._gauges.items()]
+            histograms = [[n, list(l), list(h[0]), h[1], h[2]]
+                          for (n, l), h in self._histograms.items()]
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                counters.append([name, list(_labels_key(labels)), value])
+        return {'pid': os.getpid(), 'buckets': list(self.buckets),
+                'counters': counters, 'gauges': gauges,
+                'histograms': histograms}
+
+    def maybe_flush(self):
+        if self.directory and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.directory:
+            return
+        self._last_flush = time.time()
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def reset_directory(self):
+        """启动新的一组worker之前清空metrics目录。"""
+        if not self.directory:
+            return
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            os.remove(path)
+
+    def collect(self):
+        """返回所有worker汇总之后的snapshot。"""
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._collect_directory()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _collect_directory(self):
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+        archive = _load(archive_path)
+        snapshots = []
+        dead = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == archive_path:
+                continue
+            snapshot = _load(path)
+            if snapshot is None:
+                continue
+            if _pid_alive(snapshot['pid']):
+                snapshots.append(snapshot)
+            else:
+                dead.append((path, snapshot))
+
+        if dead:
+            merged = [archive] if archive else []
+            merged.extend(dict(s, gauges=[]) for _, s in dead)
+            archive = merge(merged)
+            tmp = archive_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(archive, f)
+            os.replace(tmp, archive_path)
+            for path, _ in dead:
+                os.remove(path)
+        if archive:
+            snapshots.append(archive)
+        return snapshots
+
+    def render(self):
+        """Prometheus text format 0.0.4"""
+        data = merge(self.collect(), self._gauge_merge)
+        buckets = data['buckets']
+        lines = []
+        described = set()
+
+        def header(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self._helps.get(name, (default_kind, name))
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        for name, labels, value in sorted(data['counters']):
+            header(name, 'counter')
+            lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        for name, labels, value in sorted(data['gauges']):
+            header(name, 'gauge')
+            lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        for name, labels, counts, total, count in sorted(data['histograms']):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labels, [('le', _format_value(bound))]), cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(total)))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+        for name, labels, counts, total, count in sorted(data['histograms']):
+            quantile_name = name + '_quantile'
+            header(quantile_name, 'gauge')
+            for q in QUANTILES:
+                lines.append('%s%s %s' % (
+                    quantile_name, _format_labels(labels, [('quantile', q)]),
+                    repr(estimate_quantile(buckets, counts, count, q))))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def merge(snapshots, gauge_merge=None):
+    """counter和直方图求和，gauge按gauge_merge中的方式合并，默认求和。"""
+    gauge_merge = gauge_merge or {}
+    counters = {}
+    gauges = {}
+    histograms = {}
+    buckets = list(DEFAULT_BUCKETS)
+    for snapshot in snapshots:
+        buckets = snapshot.get('buckets', buckets)
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot['gauges']:
+            key = (name, tuple(map(tuple, labels)))
+            if key in gauges:
+                value = GAUGE_MERGE[gauge_merge.get(name, 'sum')](
+                    gauges[key], value)
+            gauges[key] = value
+        for name, labels, counts, total, count in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            hist = histograms.get(key)
+            if hist is None:
+                histograms[key] = [list(counts), total, count]
+            else:
+                hist[0] = [a + b for a, b in zip(hist[0], counts)]
+                hist[1] += total
+                hist[2] += count
+    return {
+        'buckets': buckets,
+        'counters': [[n, list(l), v] for (n, l), v in counters.items()],
+        'gauges': [[n, list(l), v] for (n, l), v in gauges.items()],
+        'histograms': [[n, list(l), h[0], h[1], h[2]]
+                       for (n, l), h in histograms.items()],
+    }
+
+
+def estimate_quantile(buckets, counts, count, q):
+    """按直方图的桶线性插值估算分位数，超出最大的桶时返回最大桶的上界。"""
+    if not count:
+        return 0.0
+    rank = q * count
+    cumulative = 0
+    lower = 0.0
+    for bound, n in zip(buckets, counts):
+        if n and cumulative + n >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / n
+        cumulative += n
+        lower = bound
+    return float(buckets[-1])
+
+
+registry = Registry()
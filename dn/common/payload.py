@@ -0,0 +1,47 @@
+import json
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import cached_property
+
+
+class RequestPayload(object):
+    """
+    一个请求的请求体只读取、解析一次，g.rawdata、g.jsondata、
+    DNView._request_data和日志共用这里的结果，用到时才解析。
+    """
+
+    def __init__(self, request, max_size=None):
+        self.request = request
+        self.max_size = max_size
+
+    @cached_property
+    def rawdata(self):
+        length = self.request.content_length
+        if self.max_size is not None and length is not None \
+                and length > self.max_size:
+            raise RequestEntityTooLarge()
+        return self.request.get_data(cache=True, parse_form_data=False)
+
+    @cached_property
+    def data(self):
+        # 先缓存原始请求体，之后解析form时读的是缓存，g.rawdata仍然可用
+        self.rawdata
+        try:
+            return self.request.get_json() or self.request.values
+        except Exception:
+            return self.request.values
+
+    @cached_property
+    def jsondata(self):
+        try:
+            self.rawdata
+            content = self.request.values.get('content')
+        except Exception:
+            # 出错时error_handler也会读取jsondata，这里不能再抛出异常
+            return {}
+        if content:
+            try:
+                return json.loads(content)
+            except Exception:
+                pass
+        return {}
@@ -0,0 +1,212 @@
+"""
+执行CPU密集型view的进程池。
+
+threads和gevent worker中纯python的计算会因为GIL阻塞同一个worker中的所有请求，
+这类view可以交给进程池执行：父进程只传入请求数据的快照（必须可以pickle），
+子进程按模块和类名找到view并调用，返回值再由父进程序列化。
+
+- 进程池在每个worker进程中按需创建，warmup()提前启动所有子进程并导入preload
+  中的模块，第一个请求不需要等待子进程启动
+- 每个子进程执行max_tasks_per_child个任务之后重启，释放计算过程中积累的内存
+- 默认使用forkserver启动子进程，避免在多线程的worker中fork
+- 启动脚本(__main__)中定义的view按脚本的文件路径导入，与multiprocessing一样以
+  __mp_main__的名字执行，`if __name__ == '__main__':` 之下的代码不会执行
+"""
+import importlib
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dn.common import log
+
+logger = log.get_logger('common.procpool')
+
+# 3.11之后ProcessPoolExecutor自己支持按任务数重启子进程，但不能和fork一起使用
+_NATIVE_RECYCLE = sys.version_info >= (3, 11)
+
+
+MAIN_MODULE = '__main__'
+# multiprocessing在子进程中按路径导入启动脚本时使用的模块名
+MP_MAIN_MODULE = '__mp_main__'
+
+
+def view_location(cls):
+    """
+    子进程中找到view需要的(模块名, 文件路径)，只有启动脚本中的view需要文件路径。
+    交互式解释器、python -c 等没有文件的__main__中的view无法在子进程中导入。
+    """
+    if cls.__module__ != MAIN_MODULE:
+        return cls.__module__, None
+    path = getattr(sys.modules[MAIN_MODULE], '__file__', None)
+    if not path:
+        raise RuntimeError(
+            'cpu_bound view %s should be defined in an importable module, '
+            '__main__ has no file' % cls.__qualname__)
+    return MAIN_MODULE, os.path.abspath(path)
+
+
+def _import_module(name, path=None):
+    if path is None:
+        return importlib.import_module(name)
+    # forkserver、spawn启动的子进程中multiprocessing可能已经按路径导入过启动脚本
+    for loaded in (MAIN_MODULE, MP_MAIN_MODULE):
+        module = sys.modules.get(loaded)
+        file = getattr(module, '__file__', None)
+        if file and os.path.abspath(file) == path:
+            return module
+    spec = importlib.util.spec_from_file_location(MP_MAIN_MODULE, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[MP_MAIN_MODULE] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[MP_MAIN_MODULE]
+        raise
+    return module
+
+
+def _init_worker(preload):
+    for name, path in preload:
+        _import_module(name, path)
+
+
+def _noop():
+    return os.getpid()
+
+
+def call_view(module_name, qualname, attr, data, kwargs=None, path=None):
+    """在子进程中调用view方法，返回值必须可以pickle。"""
+    from dn.app import _request_data_stack
+    from dn.common import aio
+
+    cls = _import_module(module_name, path)
+    for name in qualname.split('.'):
+        cls = getattr(cls, name)
+    _request_data_stack.push(data)
+    try:
+        rv = getattr(cls(), attr)(**(kwargs or {}))
+        if isinstance(rv, types.CoroutineType):
+            rv = aio.run_coroutine(rv)
+        if isinstance(rv, types.GeneratorType):
+            rv = list(rv)
+        return rv
+    finally:
+        _request_data_stack.pop()
+
+
+class ProcessPool(object):
+    def __init__(self):
+        # 注册view时加入的模块，(模块名, 文件路径)，只有启动脚本有文件路径。
+        # 注册在configure之后，重新configure时保留
+        self._view_preload = []
+        # 同一台机器上共用cpu的gunicorn worker数，由post_worker_init设置
+        self.server_workers = 1
+        self.configure()
+
+    def configure(self, workers=None, max_tasks_per_child=0,
+                  start_method='forkserver', preload=None, timeout=None,
+                  views=None, **kwargs):
+        self._workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.start_method = start_method
+        self._preload = [(name, None) for name in preload or []]
+        self.timeout = timeout
+        self.views = views or {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._submitted = 0
+
+    @property
+    def workers(self):
+        """
+        没有配置workers时按gunicorn worker数平分cpu核数，每个gunicorn worker
+        各自有一个进程池，都按cpu核数创建会让CPU密集的子进程数超过核数很多倍。
+        """
+        if self._workers:
+            return self._workers
+        return max(1, multiprocessing.cpu_count() // self.server_workers)
+
+    @property
+    def preload(self):
+        preload = list(self._preload)
+        preload += [item for item in self._view_preload if item not in preload]
+        return preload
+
+    def _create_executor(self):
+        kwargs = {}
+        if self.max_tasks_per_child and _NATIVE_RECYCLE \
+                and self.start_method != 'fork':
+            kwargs['max_tasks_per_child'] = self.max_tasks_per_child
+        return ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=_init_worker, initargs=(self.preload,), **kwargs)
+
+    @property
+    def executor(self):
+        # fork出来的gunicorn worker不能使用父进程的进程池
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = self._create_executor()
+                    self._pid = os.getpid()
+                    self._submitted = 0
+        return self._executor
+
+    def _recycle_if_needed(self):
+        """不支持max_tasks_per_child时，整个进程池执行够任务数之后替换。"""
+        if not self.max_tasks_per_child or (
+                _NATIVE_RECYCLE and self.start_method != 'fork'):
+            return
+        with self._lock:
+            self._submitted += 1
+            if self._submitted < self.max_tasks_per_child * self.workers:
+                return
+            old, self._executor = self._executor, self._create_executor()
+            self._submitted = 0
+        # 已经提交的任务执行完之后旧的子进程退出
+        old.shutdown(wait=False)
+
+    def add_preload(self, cls):
+        """
+        注册进程池执行的view时把view所在的模块加入子进程启动时导入的模块，
+        view无法在子进程中导入时抛出RuntimeError。
+        """
+        location = view_location(cls)
+        if location not in self._view_preload:
+            self._view_preload.append(location)
+
+    def warmup(self):
+        """启动所有子进程并导入preload中的模块。"""
+        executor = self.executor
+        futures = [executor.submit(_noop) for _ in range(self.workers)]
+        pids = set(f.result() for f in futures)
+        logger.info('PROCPOOL_WARMUP', ('workers', self.workers),
+                    ('started', len(pids)))
+
+    def submit(self, fn, *args):
+        self._recycle_if_needed()
+        executor = self.executor
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            # 子进程被杀掉之后进程池不可用，重建一次
+            logger.error('process pool broken, recreate')
+            with self._lock:
+                self._executor = None
+            return self.executor.submit(fn, *args)
+
+    def call_view(self, cls, attr, data, timeout=None, kwargs=None):
+        module_name, path = view_location(cls)
+        future = self.submit(call_view, module_name, cls.__qualname__,
+                             attr, data, kwargs, path)
+        return future.result(timeout or self.timeout)
+
+
+procpool = ProcessPool()
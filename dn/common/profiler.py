@@ -0,0 +1,206 @@
+"""
+线上请求的采样profile。
+
+- 按sample_rate随机抽取一部分请求用cProfile完整记录，保存为pstats格式(.prof)
+- 其余请求在执行期间由后台线程每interval秒采集一次调用栈，请求耗时超过
+  slow_timeout(毫秒)时保存为折叠栈格式(.folded，可以直接交给flamegraph.pl)，
+  没有超时就丢弃
+
+profile按endpoint保存在dir下，每个endpoint只保留最近的keep个。
+gevent worker中所有greenlet共用一个线程，调用栈采样不可用，只能使用sample_rate。
+"""
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from dn.common import log
+
+logger = log.get_logger('common.profiler')
+
+KIND_CPROFILE = 'prof'
+KIND_STACKS = 'folded'
+
+
+class StackSampler(object):
+    """后台线程定时读取sys._current_frames()，累加已登记线程的调用栈。"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_thread(self):
+        # fork出来的worker中没有父进程的线程，按pid判断是否需要重新启动
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='dn-stack-sampler')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._samples:
+                continue
+            frames = sys._current_frames()
+            for ident, samples in list(self._samples.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples[_folded_stack(frame)] += 1
+
+    def start(self):
+        self._ensure_thread()
+        samples = Counter()
+        self._samples[threading.get_ident()] = samples
+        return samples
+
+    def stop(self):
+        return self._samples.pop(threading.get_ident(), None)
+
+
+def _folded_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    stack.reverse()
+    return ';'.join(stack)
+
+
+class Profiler(object):
+    def __init__(self):
+        self.configure()
+
+    def configure(self, enabled=False, sample_rate=0.0, slow_timeout=12000,
+                  interval=0.01, dir='/tmp/dn_profiles', keep=20, token='',
+                  **kwargs):
+        self.enabled = enabled
+        self.token = token
+        self.sample_rate = sample_rate
+        self.slow_timeout = slow_timeout
+        self.dir = dir
+        self.keep = keep
+        self.sampler = StackSampler(interval) if interval else None
+
+    def start(self):
+        """请求开始时调用，返回之后传给stop()的句柄，不需要记录时返回None。"""
+        if not self.enabled:
+            return None
+        if self.sample_rate and random.random() < self.sample_rate:
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                # 同一时刻只能有一个profiler生效（python 3.12+），改用调用栈采样
+                pass
+            else:
+                return KIND_CPROFILE, prof
+        if self.sampler is not None:
+            return KIND_STACKS, self.sampler.start()
+        return None
+
+    def stop(self, handle, endpoint, cost_ms):
+        """请求结束时调用，保存了profile时返回文件路径。"""
+        if handle is None:
+            return None
+        kind, data = handle
+        if kind == KIND_CPROFILE:
+            data.disable()
+        else:
+            self.sampler.stop()
+            if cost_ms < self.slow_timeout or not data:
+                return None
+        try:
+            return self.save(kind, data, endpoint, cost_ms)
+        except (IOError, OSError) as e:
+            logger.error('save profile failed', endpoint, str(e))
+            return None
+
+    def discard(self, handle):
+        if handle is None:
+            return
+        kind, data = handle
+        if kind == KIND_CPROFILE:
+            data.disable()
+        else:
+            self.sampler.stop()
+
+    def endpoint_dir(self, endpoint):
+        return os.path.join(self.dir, endpoint.replace('/', '_'))
+
+    def save(self, kind, data, endpoint, cost_ms):
+        directory = self.endpoint_dir(endpoint)
+        os.makedirs(directory, exist_ok=True)
+        # 文件名: 毫秒时间戳_耗时_pid，按文件名排序即为时间顺序
+        name = '%d_%d_%d.%s' % (time.time() * 1000, cost_ms, os.getpid(), kind)
+        path = os.path.join(directory, name)
+        if kind == KIND_CPROFILE:
+            data.dump_stats(path)
+        else:
+            with open(path, 'w') as f:
+                for stack, count in data.most_common():
+                    f.write('%s %d\n' % (stack, count))
+        self.prune(directory)
+        return path
+
+    def prune(self, directory):
+        names = sorted(os.listdir(directory))
+        for name in names[:-self.keep]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def recent(self, limit=50):
+        """所有worker保存的profile，按时间倒序。"""
+        profiles = []
+        if not os.path.isdir(self.dir):
+            return profiles
+        for endpoint in os.listdir(self.dir):
+            directory = os.path.join(self.dir, endpoint)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                stem, _, kind = name.partition('.')
+                try:
+                    ts, cost_ms, pid = map(int, stem.split('_'))
+                except ValueError:
+                    continue
+                profiles.append({
+                    'endpoint': endpoint, 'name': '%s/%s' % (endpoint, name),
+                    'kind': kind, 'time': ts / 1000.0, 'cost_ms': cost_ms,
+                    'pid': pid,
+                })
+        profiles.sort(key=lambda p: p['time'], reverse=True)
+        return profiles[:limit]
+
+    def render(self, name, limit=40):
+        """profile的文本内容，cProfile按累计耗时输出前limit个函数。"""
+        path = os.path.realpath(os.path.join(self.dir, name))
+        if not path.startswith(os.path.realpath(self.dir) + os.sep) \
+                or not os.path.isfile(path):
+            return None
+        if path.endswith('.' + KIND_CPROFILE):
+            out = io.StringIO()
+            stats = pstats.Stats(path, stream=out)
+            stats.sort_stats('cumulative').print_stats(limit)
+            return out.getvalue()
+        with open(path) as f:
+            return f.read()
+
+
+profiler = Profiler()
@@ -0,0 +1,162 @@
+"""
+令牌桶限流。
+
+每条规则按rule（'*'表示所有rule共用一个桶）和客户端标识（remote_addr、app_id
+或者自定义函数）分桶，桶以rate个/秒的速度补充令牌，最多积累burst个，每个请求
+消耗一个令牌，没有令牌时拒绝并返回需要等待的秒数。
+
+配置了redis时令牌桶保存在redis中，通过RedisScript原子地补充和扣减，所有worker
+和机器共用同一个桶；没有redis时退化为进程内的令牌桶，限制针对单个worker进程。
+redis出错时放行请求。
+"""
+import importlib
+import threading
+import time
+from collections import OrderedDict
+
+from dn.common.metrics import registry
+
+# 时间取自redis服务器，不受各台机器时钟偏差的影响；redis 5之前的版本需要先切换为
+# 按写命令复制，才能在TIME之后写入
+TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class MemoryBuckets(object):
+    """进程内的令牌桶，桶的个数超过maxsize时淘汰最久没有访问的。"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + max(0, now - bucket[1]) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBuckets(object):
+    def __init__(self, client, key_prefix='dn:ratelimit:'):
+        from dn.common.wrappers import RedisScript
+        self.client = client
+        self.key_prefix = key_prefix
+        self.script = RedisScript('token_bucket', TOKEN_BUCKET_SCRIPT,
+                                  client=client)
+
+    def take(self, key, rate, burst):
+        wait = self.script([self.key_prefix + key], [rate, burst])
+        # RedisScript出错时已经记录日志并返回None，此时放行
+        return float(wait) if wait is not None else 0.0
+
+
+class Rule(object):
+    def __init__(self, match, by, rate, burst=None):
+        if rate <= 0:
+            raise RuntimeError('ratelimit rate should be positive: %s' % rate)
+        self.match = match
+        self.by = by
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+
+class RateLimiter(object):
+    def __init__(self):
+        self.key_funcs = {}
+        self.configure(backend='memory')
+
+    def configure(self, enabled=True, backend=None, redis=None,
+                  key_prefix='dn:ratelimit:', maxsize=10000, rules=None,
+                  **kwargs):
+        self.enabled = enabled
+        self.rules = [Rule(**r) for r in rules or []]
+        self._rules_of = {}
+        if backend is None:
+            # 没有指定时，配置了redis就使用redis
+            from dn.common.globals import config
+            backend = 'redis' if redis or config.redis.get('instances') \
+                else 'memory'
+        if backend == 'redis':
+            from dn.common.globals import config
+            from dn.common.wrappers import RedisStore
+            url = redis or (config.redis.get('instances') or [None])[0]
+            if not url:
+                raise RuntimeError('redis url should be set for ratelimit')
+            self.buckets = RedisBuckets(RedisStore.create(url), key_prefix)
+        elif backend == 'memory':
+            self.buckets = MemoryBuckets(maxsize)
+        else:
+            raise RuntimeError('unknown ratelimit backend: %s' % backend)
+
+    def register_key_func(self, name, func):
+        """func()返回客户端标识，返回None时不限制这个请求。"""
+        self.key_funcs[name] = func
+
+    def key_func(self, by):
+        func = self.key_funcs.get(by)
+        if func is None and ':' in by:
+            module_name, _, name = by.partition(':')
+            func = getattr(importlib.import_module(module_name), name)
+            self.key_funcs[by] = func
+        if func is None:
+            raise RuntimeError('unknown ratelimit key: %s' % by)
+        return func
+
+    def rules_of(self, rule_name):
+        rules = self._rules_of.get(rule_name)
+        if rules is None:
+            rules = self._rules_of[rule_name] = [
+                r for r in self.rules if r.match in ('*', rule_name)]
+        return rules
+
+    def check(self, rule_name):
+        """返回需要等待的秒数，没有超过限制时返回0。"""
+        if not self.enabled:
+            return 0
+        for rule in self.rules_of(rule_name):
+            client = self.key_func(rule.by)()
+            if client is None:
+                continue
+            key = '%s:%s:%s' % (rule.match, rule.by, client)
+            wait = self.buckets.take(key, rule.rate, rule.burst)
+            if wait > 0:
+                registry.inc('dn_ratelimit_rejected_total',
+                             {'rule': rule.match, 'by': rule.by})
+                return wait
+        return 0
+
+
+ratelimiter = RateLimiter()
@@ -0,0 +1,69 @@
+"""
+生产环境的滚动更新。
+
+gunicorn的master收到SIGHUP（或者调用 POST /_reload）时：
+
+1. master重新导入DNView所在的模块以及modules中配置的模块，按新的代码重新注册路由
+2. 从master fork出新的worker，新的worker直接使用已经导入的代码，没有冷启动
+3. 旧的worker收到SIGTERM，处理完正在处理的请求之后退出（参见优雅退出）
+
+重新导入失败（例如语法错误）时继续使用旧的代码，新的worker和以前完全相同。
+"""
+import importlib
+import sys
+
+from dn.common import log
+
+logger = log.get_logger('common.reload')
+
+
+def unique_classes(classes):
+    """
+    重新导入模块之后旧的类还在__subclasses__()中，
+    同一个模块和类名只保留最后定义的。
+    """
+    by_id = {}
+    for cls in classes:
+        class_id = '%s:%s' % (cls.__module__, cls.__qualname__)
+        by_id.pop(class_id, None)
+        by_id[class_id] = cls
+    return list(by_id.values())
+
+
+class ViewReloader(object):
+    def __init__(self):
+        # gunicorn worker中为master的pid，不在gunicorn中运行时为None
+        self.master_pid = None
+        self.configure()
+
+    def configure(self, enabled=False, token=None, modules=None, **kwargs):
+        self.enabled = enabled
+        self.token = token
+        self.modules = list(modules or [])
+        if enabled and not token:
+            logger.warning('RELOAD_DISABLED', 'POST /_reload requires a token')
+
+    def view_modules(self, classes, exclude=()):
+        """DNView子类所在的模块，按导入的顺序，基类所在的模块先重新导入。"""
+        names = set(cls.__module__ for cls in classes)
+        return [name for name in sys.modules
+                if name in names and name not in exclude
+                and name != '__main__' and not name.startswith('dn.')]
+
+    def reload(self, classes, exclude=()):
+        """重新导入modules和view所在的模块，返回重新导入的模块名。"""
+        importlib.invalidate_caches()
+        names = [name for name in self.modules if name not in exclude]
+        names += [name for name in self.view_modules(classes, exclude)
+                  if name not in names]
+        for name in names:
+            module = sys.modules.get(name)
+            if module is None:
+                importlib.import_module(name)
+            else:
+                importlib.reload(module)
+        logger.info('RELOAD_MODULES', ('modules', ','.join(names)))
+        return names
+
+
+reloader = ViewReloader()
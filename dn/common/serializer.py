@@ -0,0 +1,172 @@
+import datetime
+import decimal
+import json
+import uuid
+
+from werkzeug.http import http_date
+
+from dn.common import log
+from dn.common.sqldb import BaseModel
+
+from sqlalchemy import inspect
+
+logger = log.get_logger('common.serializer')
+
+BACKENDS = ('flask', 'json', 'simplejson', 'orjson')
+
+_model_fields = {}
+
+
+def model_fields(cls):
+    fields = _model_fields.get(cls)
+    if fields is None:
+        fields = tuple(attr.key for attr in inspect(cls).column_attrs)
+        _model_fields[cls] = fields
+    return fields
+
+
+def model_to_dict(obj):
+    return {name: getattr(obj, name) for name in model_fields(obj.__class__)}
+
+
+class JSONSerializer(object):
+    """
+    把view返回的list、dict直接编码成utf-8的bytes。
+
+    backend:
+        flask       沿用flask的jsonify，默认值
+        json        标准库json，紧凑格式，不排序key
+        simplejson  simplejson，Decimal按原样输出
+        orjson      orjson，需要另外安装，直接生成bytes，速度最快
+    datetime_format:
+        http        与jsonify一致，输出 Wed, 21 Oct 2015 07:28:00 GMT
+        iso         输出 2015-10-21T07:28:00
+    decimal_format:
+        float       转换成float输出，默认值，与以前的输出一致，但是会丢失精度
+        str         输出为字符串，不丢失精度，客户端需要自己转换
+    """
+
+    def __init__(self, backend='flask', datetime_format='http',
+                 decimal_format='float'):
+        self.configure(backend=backend, datetime_format=datetime_format,
+                       decimal_format=decimal_format)
+
+    def configure(self, backend='flask', datetime_format='http',
+                  decimal_format='float', **kwargs):
+        if backend not in BACKENDS:
+            raise RuntimeError('unknown json backend: %s' % backend)
+        if datetime_format not in ('http', 'iso'):
+            raise RuntimeError('unknown datetime_format: %s' % datetime_format)
+        if decimal_format not in ('float', 'str'):
+            raise RuntimeError('unknown decimal_format: %s' % decimal_format)
+        if backend == 'orjson':
+            try:
+                import orjson  # noqa
+            except ImportError:
+                logger.error('ALERT', 'orjson is not installed, use json instead')
+                backend = 'json'
+        self.backend = backend
+        self.datetime_format = datetime_format
+        self.decimal_format = decimal_format
+        self.dumps = getattr(self, '_dumps_%s' % backend)
+        # 流式输出自己加换行和逗号，按行编码时不需要jsonify末尾的换行
+        if backend == 'flask':
+            self.dumps_row = self._dumps_flask_row
+        else:
+            self.dumps_row = self.dumps
+
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            if self.datetime_format == 'iso':
+                return obj.isoformat()
+            return http_date(obj.utctimetuple())
+        if isinstance(obj, datetime.date):
+            if self.datetime_format == 'iso':
+                return obj.isoformat()
+            return http_date(obj.timetuple())
+        if isinstance(obj, decimal.Decimal):
+            if self.decimal_format == 'str':
+                return str(obj)
+            return float(obj)
+        if isinstance(obj, BaseModel):
+            return model_to_dict(obj)
+        if hasattr(obj, '_asdict'):
+            # sqlalchemy查询指定列时返回的行
+            return obj._asdict()
+        if isinstance(obj, uuid.UUID):
+            return str(obj)
+        if isinstance(obj, (set, frozenset)):
+            return list(obj)
+        if hasattr(obj, 'keys') and hasattr(obj, '__getitem__'):
+            # sqlalchemy execute返回的RowProxy
+            return {key: obj[key] for key in obj.keys()}
+        raise TypeError('%r is not JSON serializable' % (obj,))
+
+    def _dumps_flask(self, obj):
+        # 与jsonify的输出一致，末尾带换行
+        return self._dumps_flask_row(obj) + b'\n'
+
+    def _dumps_flask_row(self, obj):
+        from flask import json as flask_json
+        return flask_json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def _dumps_json(self, obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                          default=self.default).encode('utf-8')
+
+    def _dumps_simplejson(self, obj):
+        import simplejson
+        # decimal_format为float时simplejson按原样输出Decimal，不经过default
+        return simplejson.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                                default=self.default,
+                                use_decimal=self.decimal_format != 'str'
+                                ).encode('utf-8')
+
+    def _dumps_orjson(self, obj):
+        import orjson
+        option = orjson.OPT_NON_STR_KEYS
+        if self.datetime_format == 'http':
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def iter_ndjson(self, rows, chunk_size=65536):
+        """每行一个json，攒够chunk_size字节输出一次。"""
+        dumps = self.dumps_row
+        chunk = []
+        size = 0
+        for row in rows:
+            line = dumps(row)
+            chunk.append(line)
+            size += len(line) + 1
+            if size >= chunk_size:
+                chunk.append(b'')
+                yield b'\n'.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            chunk.append(b'')
+            yield b'\n'.join(chunk)
+
+    def iter_json_array(self, rows, chunk_size=65536):
+        """逐行编码，输出一个完整的json数组。"""
+        dumps = self.dumps_row
+        chunk = [b'[']
+        size = 1
+        first = True
+        for row in rows:
+            data = dumps(row)
+            if first:
+                first = False
+            else:
+                chunk.append(b',')
+            chunk.append(data)
+            size += len(data) + 1
+            if size >= chunk_size:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append(b']')
+        yield b''.join(chunk)
+
+
+serializer = JSONSerializer()
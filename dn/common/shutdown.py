@@ -0,0 +1,179 @@
+"""
+优雅退出。
+
+worker收到SIGTERM之后：
+
+1. 标记为draining，/health/ready 立即返回503，负载均衡不再转发新的请求
+2. 等待drain_delay秒（给负载均衡摘除的时间）之后停止接受新的连接
+3. 最多等待timeout秒，直到正在处理的请求和后台任务都结束
+4. 执行注册的清理函数：dispose数据库连接池、断开redis连接等
+
+gunicorn的master在graceful_timeout之后会强制杀掉worker，
+drain_delay加上timeout不应当超过server.graceful_timeout。
+"""
+import os
+import signal
+import threading
+import time
+
+from dn.common import log
+
+logger = log.get_logger('common.shutdown')
+
+# 开发服务器的主线程空闲时所在的函数：socketserver等待新的连接
+IDLE_FRAMES = ('select', 'serve_forever')
+
+
+class GracefulShutdown(object):
+    def __init__(self):
+        self._callbacks = []
+        self.configure()
+
+    def configure(self, timeout=30, drain_delay=0, **kwargs):
+        self.timeout = timeout
+        self.drain_delay = drain_delay
+        self.draining = False
+        self.draining_since = None
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._cleaned = False
+
+    def register(self, func):
+        """注册退出前执行的清理函数，按注册的顺序执行。"""
+        if func not in self._callbacks:
+            self._callbacks.append(func)
+        return func
+
+    @property
+    def inflight(self):
+        return self._inflight
+
+    def enter(self):
+        with self._cond:
+            self._inflight += 1
+
+    def leave(self):
+        with self._cond:
+            self._inflight -= 1
+            if self._inflight <= 0:
+                self._cond.notify_all()
+
+    def begin(self):
+        if not self.draining:
+            self.draining = True
+            self.draining_since = time.time()
+            logger.info('SHUTDOWN_BEGIN', ('pid', os.getpid()),
+                        ('inflight', self._inflight))
+
+    def wait(self, timeout=None):
+        """等待正在处理的请求结束，返回超时之后还没有结束的个数。"""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._inflight > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._inflight
+
+    def cleanup(self):
+        if self._cleaned:
+            return
+        self._cleaned = True
+        for func in self._callbacks:
+            try:
+                func()
+            except Exception as e:
+                logger.error('shutdown cleanup error',
+                             getattr(func, '__name__', repr(func)), str(e))
+
+    def drain(self, timeout=None):
+        self.begin()
+        started = time.time()
+        remaining = self.wait(timeout)
+        if remaining:
+            logger.warning('SHUTDOWN_TIMEOUT', ('inflight', remaining))
+        self.cleanup()
+        logger.info('SHUTDOWN_DONE', ('pid', os.getpid()),
+                    ('abandoned', remaining),
+                    ('wait', round(time.time() - started, 3)))
+        return remaining
+
+    def install_worker(self, worker):
+        """
+        gunicorn worker中替换SIGTERM的处理，先标记为draining，
+        drain_delay秒之后再交给worker停止接受新的连接。
+        """
+        handle_exit = signal.getsignal(signal.SIGTERM)
+        if not callable(handle_exit):
+            handle_exit = worker.handle_exit
+        delayed = []
+
+        def resend():
+            delayed.append(True)
+            # 重新发送信号，worker的主循环通过wakeup fd被唤醒
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        def on_sigterm(sig, frame):
+            if not self.drain_delay or delayed:
+                self.begin()
+                return handle_exit(sig, frame)
+            if self.draining:
+                return
+            self.begin()
+            timer = threading.Timer(self.drain_delay, resend)
+            timer.daemon = True
+            timer.start()
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+    def install(self):
+        """
+        不使用gunicorn时（例如app.run）处理SIGTERM。信号处理在主线程中执行，
+        单线程的开发服务器中主线程可能正在处理请求，这里只标记为draining，
+        在另一个线程中等待请求结束之后中断主线程的serve loop，
+        serve loop返回之后由调用者执行drain()关闭连接池。
+        """
+        stopping = []
+
+        def stop():
+            if self.drain_delay:
+                time.sleep(self.drain_delay)
+            remaining = self.wait()
+            if remaining:
+                logger.warning('SHUTDOWN_TIMEOUT', ('inflight', remaining))
+            stopping.append(True)
+            # 再次发送信号，由主线程停止serve loop
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        def on_sigterm(sig, frame):
+            if stopping:
+                if frame is not None and frame.f_code.co_name in IDLE_FRAMES:
+                    # werkzeug的serve_forever捕获KeyboardInterrupt之后关闭监听的socket
+                    raise KeyboardInterrupt()
+                # teardown_request之后主线程还在写响应，稍后再试
+                timer = threading.Timer(0.05, os.kill,
+                                        (os.getpid(), signal.SIGTERM))
+                timer.daemon = True
+                timer.start()
+                return
+            if self.draining:
+                return
+            self.begin()
+            thread = threading.Thread(target=stop, name='dn-shutdown')
+            thread.daemon = True
+            thread.start()
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+
+def close_redis_pools():
+    from dn.common.globals import config
+    # 没有用到redis时不要为了关闭而创建连接
+    for client in getattr(config, '_redis_instances', None) or []:
+        client.connection_pool.disconnect()
+
+
+shutdown = GracefulShutdown()
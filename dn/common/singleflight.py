@@ -0,0 +1,193 @@
+"""
+相同请求的合并执行(single flight)。
+
+同一个worker中同时到达的相同请求（rule和请求数据都相同）只执行一次，其余的
+等待并共用这次执行的结果或者异常。distributed为True时还通过redis锁在worker
+和机器之间合并：拿到锁的worker执行并把结果写回redis，其他worker轮询结果，
+等待超时或者持锁的worker退出时各自执行。
+"""
+import json
+import threading
+import time
+import uuid
+
+from dn.common import log
+from dn.common.cache import request_data_digest
+from dn.common.metrics import registry
+
+logger = log.get_logger('common.singleflight')
+
+# 只有锁的持有者才能释放锁
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, on_shared=None):
+        """
+        返回(func()的结果, 是否共用了其他请求的结果)，共用结果或者异常时
+        先调用on_shared()。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if on_shared is not None:
+                on_shared()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+
+class RedisFlight(object):
+    def __init__(self, client, key_prefix='dn:flight:', lock_ttl=10,
+                 result_ttl=5, wait_timeout=10, poll_interval=0.05):
+        from dn.common.wrappers import RedisScript
+        self.client = client
+        self.key_prefix = key_prefix
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.release_script = RedisScript('flight_release', RELEASE_SCRIPT,
+                                          client=client)
+
+    def do(self, key, func):
+        """func返回(status, headers, body)，结果写回redis供其他worker使用。"""
+        lock_key = self.key_prefix + 'lock:' + key
+        token = uuid.uuid4().hex
+        try:
+            locked = self.client.set(lock_key, token, nx=True,
+                                     px=int(self.lock_ttl * 1000))
+            owner = None if locked else self.client.get(lock_key)
+        except Exception as e:
+            logger.error('redis flight lock error', key, str(e))
+            return func(), False
+        if not locked:
+            result = None
+            if owner is not None:
+                result = self.wait(lock_key, owner.decode('utf-8'))
+            if result is not None:
+                return result, True
+            return func(), False
+        # 结果按持锁者的token保存，等待者只会读到这一次执行的结果
+        result_key = self.key_prefix + 'result:' + token
+        try:
+            result = func()
+            if result is not None:
+                status, headers, body = result
+                self.client.hset(result_key, mapping={
+                    'status': status, 'headers': json.dumps(headers),
+                    'body': body})
+                self.client.pexpire(result_key, int(self.result_ttl * 1000))
+            return result, False
+        finally:
+            self.release_script([lock_key], [token])
+
+    def wait(self, lock_key, owner):
+        result_key = self.key_prefix + 'result:' + owner
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                pipe.hmget(result_key, 'status', 'headers', 'body')
+                pipe.get(lock_key)
+                (status, headers, body), current = pipe.execute()
+            except Exception as e:
+                logger.error('redis flight wait error', result_key, str(e))
+                return None
+            if body is not None:
+                headers = [tuple(h) for h in json.loads(headers)]
+                return int(status), headers, body
+            if current is None or current.decode('utf-8') != owner:
+                # 持锁的worker出错或者退出，没有写回结果
+                return None
+        return None
+
+
+class Coalescer(object):
+    """DNApp使用的入口，按rule和请求数据合并相同的请求。"""
+
+    def __init__(self):
+        self.local = SingleFlight()
+        self.configure()
+
+    def configure(self, views=None, redis=None, key_prefix='dn:flight:',
+                  lock_ttl=10, result_ttl=5, wait_timeout=10,
+                  poll_interval=0.05, **kwargs):
+        self.views = views or {}
+        self._redis_options = dict(
+            redis=redis, key_prefix=key_prefix, lock_ttl=lock_ttl,
+            result_ttl=result_ttl, wait_timeout=wait_timeout,
+            poll_interval=poll_interval)
+        self._remote = None
+
+    @property
+    def remote(self):
+        # 只有用到distributed时才连接redis
+        if self._remote is None:
+            from dn.common.globals import config
+            from dn.common.wrappers import RedisStore
+            options = dict(self._redis_options)
+            url = options.pop('redis') \
+                or (config.redis.get('instances') or [None])[0]
+            if not url:
+                raise RuntimeError('redis url should be set for coalesce')
+            self._remote = RedisFlight(RedisStore.create(url), **options)
+        return self._remote
+
+    def key(self, rule, data):
+        return '%s:%s' % (rule, request_data_digest(data))
+
+    def do(self, rule, data, func, distributed=False):
+        """
+        func返回(status, headers, body)，相同的并发请求共用一次执行的结果，
+        headers为(name, value)的列表。
+        """
+        key = self.key(rule, data)
+
+        def local_func():
+            if distributed:
+                return self.remote.do(key, func)
+            return func(), False
+
+        def on_shared():
+            registry.inc('dn_coalesced_total', {'rule': rule, 'scope': 'local'})
+
+        (result, remote_shared), shared = self.local.do(key, local_func,
+                                                        on_shared)
+        if remote_shared and not shared:
+            registry.inc('dn_coalesced_total', {'rule': rule, 'scope': 'redis'})
+        return result
+
+
+coalescer = Coalescer()
@@ -32,7 +32,7 @@ def update_dbsession_used(name):
     used.add(name)
 
 
-def get_dbsession(name='default'):
+def get_dbsession_class(name='default'):
     from .globals import config
     if name not in dbsession_cache:
         conf = config.sqldb.get(name, {})
@@ -40,7 +40,15 @@ def get_dbsession(name='default'):
         dbsession = scoped_session(
             sessionmaker(autocommit=False, autoflush=False, bind=engine))
         dbsession_cache[name] = dbsession
-    dbsession_class = dbsession_cache[name]
+    return dbsession_cache[name]
+
+
+def get_engine(name='default'):
+    return get_dbsession_class(name).session_factory.kw['bind']
+
+
+def get_dbsession(name='default'):
+    dbsession_class = get_dbsession_class(name)
     update_dbsession_used(name)
     dbsession_class()
     return dbsession_class
@@ -57,3 +65,14 @@ def clear_dbsession():
         except Exception:
             logger.error('error while clear dbsession')
             logger.traceback()
+
+
+def dispose_engines():
+    """退出前关闭所有连接池，连接池中的连接不再等待mysql超时断开。"""
+    for name, dbsession_class in list(dbsession_cache.items()):
+        try:
+            dbsession_class.remove()
+            dbsession_class.session_factory.kw['bind'].dispose()
+        except Exception:
+            logger.error('error while dispose engine', name)
+            logger.traceback()
@@ -0,0 +1,279 @@
+"""
+请求的追踪。
+
+- 每个请求都有request id：请求头中带了合法的id时沿用，否则生成新的，
+  响应头中返回，请求过程中的每一行日志都带上 rid=<request id>
+- 按sample_rate在请求开始时决定是否记录这个请求(head-based sampling)，
+  记录的请求把view、sql、redis命令、redis脚本、AutoloadResource的加载作为span，
+  请求结束时整个trace写入文件(一行一个json)或者以UDP发给本机的collector
+- 没有记录的请求每个埋点只多一次ContextVar的读取
+"""
+import contextvars
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+
+from dn.common import log
+
+logger = log.get_logger('common.tracing')
+
+_current = contextvars.ContextVar('dn_trace', default=None)
+
+_valid_request_id = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class Trace(object):
+    __slots__ = ('request_id', 'started', 'perf_started', 'spans', 'stack',
+                 'last_id', 'max_spans', 'dropped', 'attrs')
+
+    def __init__(self, request_id, max_spans):
+        self.request_id = request_id
+        self.started = time.time()
+        self.perf_started = time.perf_counter()
+        self.spans = []
+        # 正在执行的span的id，0为请求本身
+        self.stack = [0]
+        self.last_id = 0
+        self.max_spans = max_spans
+        self.dropped = 0
+        self.attrs = {}
+
+    def to_dict(self):
+        duration = (time.perf_counter() - self.perf_started) * 1000
+        summary = {}
+        for span in self.spans:
+            item = summary.setdefault(span['name'], {'count': 0, 'ms': 0.0})
+            item['count'] += 1
+            item['ms'] = round(item['ms'] + span['duration_ms'], 3)
+        record = {'request_id': self.request_id, 'start': self.started,
+                  'duration_ms': round(duration, 3), 'summary': summary,
+                  'spans': self.spans, 'dropped': self.dropped}
+        record.update(self.attrs)
+        return record
+
+
+class Span(object):
+    __slots__ = ('trace', 'name', 'attrs', 'started', 'id', 'parent')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def __enter__(self):
+        trace = self.trace
+        trace.last_id += 1
+        self.id = trace.last_id
+        self.parent = trace.stack[-1]
+        trace.stack.append(self.id)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ended = time.perf_counter()
+        trace = self.trace
+        if trace.stack and trace.stack[-1] == self.id:
+            trace.stack.pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        if len(trace.spans) >= trace.max_spans:
+            trace.dropped += 1
+            return False
+        span = {'id': self.id, 'parent': self.parent, 'name': self.name,
+                'start_ms': round((self.started - trace.perf_started) * 1000, 3),
+                'duration_ms': round((ended - self.started) * 1000, 3)}
+        if self.attrs:
+            span['attrs'] = self.attrs
+        trace.spans.append(span)
+        return False
+
+
+class _NoopSpan(object):
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class FileExporter(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def export(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            if self._file is None or self._pid != os.getpid():
+                # fork之后各个worker分别打开，以追加的方式写同一个文件
+                dirname = os.path.dirname(self.path)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+                self._pid = os.getpid()
+            self._file.write(line)
+            self._file.flush()
+
+
+class UDPExporter(object):
+    """每个trace一个json的UDP包，发给本机的collector，不等待也不重试。"""
+
+    max_size = 60000
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self._sock = None
+        self._pid = None
+
+    def export(self, record):
+        data = json.dumps(record, default=str).encode('utf-8')
+        if len(data) > self.max_size:
+            # 超过UDP包的大小时只发送汇总
+            record = dict(record, spans=[],
+                          dropped=record['dropped'] + len(record['spans']))
+            data = json.dumps(record, default=str).encode('utf-8')
+        if self._sock is None or self._pid != os.getpid():
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+            self._pid = os.getpid()
+        try:
+            self._sock.sendto(data, self.address)
+        except OSError:
+            pass
+
+
+class Tracer(object):
+    def __init__(self):
+        self._sqlalchemy_installed = False
+        self.configure()
+
+    def configure(self, enabled=True, header='X-Request-ID', sample_rate=0.0,
+                  exporter='file', path='/tmp/dn_traces.jsonl',
+                  address='127.0.0.1:6831', max_spans=256,
+                  statement_length=200, **kwargs):
+        self.enabled = enabled
+        self.header = header
+        self.environ_key = 'HTTP_' + header.upper().replace('-', '_')
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.statement_length = statement_length
+        if exporter == 'file':
+            self.exporter = FileExporter(path)
+        elif exporter == 'udp':
+            self.exporter = UDPExporter(address)
+        else:
+            raise RuntimeError('unknown trace exporter: %s' % exporter)
+        if enabled and sample_rate:
+            self.install_sqlalchemy()
+
+    def request_id_of(self, environ):
+        """请求头中的request id合法时沿用，否则生成新的。"""
+        request_id = environ.get(self.environ_key)
+        if request_id and _valid_request_id.match(request_id):
+            return request_id
+        return uuid.uuid4().hex
+
+    def start(self, request_id, sample=True):
+        """请求开始时调用，sample为False时只设置request id，不记录span。"""
+        log.request_id.set(request_id)
+        if sample and self.sample_rate \
+                and random.random() < self.sample_rate:
+            trace = Trace(request_id, self.max_spans)
+            _current.set(trace)
+            return trace
+        _current.set(None)
+        return None
+
+    def current(self):
+        return _current.get()
+
+    def thread_context(self):
+        """
+        交给其他线程执行的工作（事件循环、/_batch的线程池、后台任务）使用的
+        context：带上当前请求的request id，日志照常带rid；不带trace，span的栈
+        不能在多个线程之间共用。每次提交都需要新的context，同一个context不能
+        同时在多个线程中执行。
+        """
+        context = contextvars.copy_context()
+        context.run(_current.set, None)
+        return context
+
+    def span(self, name, **attrs):
+        trace = _current.get()
+        if trace is None:
+            return NOOP_SPAN
+        return Span(trace, name, attrs)
+
+    def finish(self, **attrs):
+        """请求结束时调用，导出记录下来的trace。"""
+        trace = _current.get()
+        _current.set(None)
+        log.request_id.set(None)
+        if trace is None:
+            return None
+        trace.attrs.update(attrs)
+        record = trace.to_dict()
+        try:
+            self.exporter.export(record)
+        except Exception as e:
+            logger.error('export trace error', str(e))
+        return record
+
+    def install_sqlalchemy(self):
+        """所有engine执行的sql作为span，没有被采样的请求中只多一次ContextVar的读取。"""
+        if self._sqlalchemy_installed:
+            return
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        def before_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+            trace = _current.get()
+            if trace is None or context is None:
+                return
+            span = Span(trace, 'sql', {
+                'statement': statement[:self.statement_length],
+                'db': conn.engine.url.database})
+            if executemany:
+                span.attrs['executemany'] = True
+            context._dn_span = span.__enter__()
+
+        def after_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+            span = getattr(context, '_dn_span', None)
+            if span is not None:
+                context._dn_span = None
+                span.__exit__(None, None, None)
+
+        def handle_error(exception_context):
+            context = exception_context.execution_context
+            span = getattr(context, '_dn_span', None)
+            if span is not None:
+                context._dn_span = None
+                error = exception_context.original_exception
+                span.__exit__(type(error), error, None)
+
+        event.listen(Engine, 'before_cursor_execute', before_execute)
+        event.listen(Engine, 'after_cursor_execute', after_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+        self._sqlalchemy_installed = True
+
+
+tracer = Tracer()
@@ -4,6 +4,7 @@ from redis import Redis
 
 from dn.common import log
 from dn.common.memoize import MemoizeMetaclass
+from dn.common.tracing import tracer
 
 logger = log.get_logger('common.wrappers')
 
@@ -35,6 +36,12 @@ class RedisClient(Redis):
         config.update(kwargs)
         return cls(**config)
 
+    def execute_command(self, *args, **options):
+        if tracer.current() is None:
+            return super(RedisClient, self).execute_command(*args, **options)
+        with tracer.span('redis', command=args[0]):
+            return super(RedisClient, self).execute_command(*args, **options)
+
 
 class RedisStore(RedisClient):
     pass
@@ -148,7 +155,8 @@ class RedisScript(object):
         script = self.registered_script(client)
         ret = None
         try:
-            ret = script(keys, args, client=client)
+            with tracer.span('redis.script', script=self.name):
+                ret = script(keys, args, client=client)
         except Exception as e:
             logger.error(
                 'redis script %s error, message:%s' % (self.name, str(e)))
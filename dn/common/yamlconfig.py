@@ -5,6 +5,7 @@ import time
 from functools import reduce
 
 from dn.common import log
+from dn.common.tracing import tracer
 from dn.common.wrappers import RedisStore
 
 import yaml
@@ -165,6 +166,10 @@ class AutoloadResource(object):
         return self._data
 
     def load(self):
+        with tracer.span('autoload', name=self.name, location=self.location):
+            self._load()
+
+    def _load(self):
         logger.debug('autolaod_resource_load', self.to_dict())
 
         data = None
@@ -179,7 +184,7 @@ class AutoloadResource(object):
             data = self.load_rs_value()
 
         if self.name[-5:] == '.yaml' and data:
-            data = yaml.load(data)
+            data = yaml.load(data, Loader=yaml.Loader)
 
         if self.preprocessor:
             logger.debug(
@@ -345,7 +350,7 @@ class YamlConfig(ReadOnlyDict):
             return
         self._create_config_from_template(config_file)
         with open(config_file, encoding='UTF-8') as f:
-            c = yaml.load(f)
+            c = yaml.load(f, Loader=yaml.Loader)
             self.update(c)
         self._redis_instances = None
 
@@ -366,7 +371,7 @@ class YamlConfig(ReadOnlyDict):
 
             remote_config = None
             try:
-                remote_config = yaml.load(config_string)
+                remote_config = yaml.load(config_string, Loader=yaml.Loader)
                 assert not isinstance(remote_config, str)
             except Exception as e:
                 import traceback
@@ -469,6 +474,106 @@ class YamlConfig(ReadOnlyDict):
         return self.get('main', {}).\
             get('request', {}).get('slow_timeout', 12000)
 
+    @property
+    def json(self):
+        conf = self.get('main', {}).get('json', {})
+        conf.setdefault('backend', 'flask')
+        conf.setdefault('datetime_format', 'http')
+        return conf
+
+    @property
+    def cache(self):
+        conf = self.get('main', {}).get('cache', {})
+        conf.setdefault('backend', 'memory')
+        conf.setdefault('maxsize', 1024)
+        conf.setdefault('ttl', 60)
+        conf.setdefault('views', {})
+        return conf
+
+    @property
+    def etag(self):
+        return self.get('main', {}).get('etag', {})
+
+    @property
+    def compress(self):
+        conf = self.get('main', {}).get('compress', {})
+        conf.setdefault('enabled', True)
+        conf.setdefault('min_size', 500)
+        conf.setdefault('level', 6)
+        return conf
+
+    @property
+    def request_max_body_size(self):
+        return self.get('main', {}).\
+            get('request', {}).get('max_body_size')
+
+    @property
+    def server(self):
+        return self.get('main', {}).get('server', {})
+
+    @property
+    def metrics(self):
+        conf = self.get('main', {}).get('metrics', {})
+        conf.setdefault('enabled', True)
+        conf.setdefault('flush_interval', 1)
+        return conf
+
+    @property
+    def profile(self):
+        conf = self.get('main', {}).get('profile', {})
+        conf.setdefault('enabled', False)
+        conf.setdefault('slow_timeout', self.request_slow_timeout)
+        return conf
+
+    @property
+    def admission(self):
+        conf = self.get('main', {}).get('admission', {})
+        conf.setdefault('enabled', True)
+        conf.setdefault('retry_after', 1)
+        return conf
+
+    @property
+    def ratelimit(self):
+        return self.get('main', {}).get('ratelimit', {})
+
+    @property
+    def coalesce(self):
+        return self.get('main', {}).get('coalesce', {})
+
+    @property
+    def jobs(self):
+        return self.get('main', {}).get('jobs', {})
+
+    @property
+    def procpool(self):
+        return self.get('main', {}).get('procpool', {})
+
+    @property
+    def cors(self):
+        return self.get('main', {}).get('cors', {})
+
+    @property
+    def errors(self):
+        return self.get('main', {}).get('errors', {})
+
+    @property
+    def health(self):
+        return self.get('main', {}).get('health', {})
+
+    @property
+    def tracing(self):
+        return self.get('main', {}).get('tracing', {})
+
+    @property
+    def reload(self):
+        return self.get('main', {}).get('reload', {})
+
+    @property
+    def shutdown(self):
+        conf = self.get('main', {}).get('shutdown', {})
+        conf.setdefault('timeout', self.server.get('graceful_timeout', 30))
+        return conf
+
     @property
     def redynadb(self):
         return self.get('main', {}).get('redynadb', {})
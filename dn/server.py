@@ -0,0 +1,176 @@
+"""
+生产环境的prefork服务，基于gunicorn。
+
+    # 在代码中
+    app = DNApp.register_view_func()
+    app.serve()
+
+    # 或者命令行，server为模块名，app为其中的DNApp对象
+    dn-serve server:app --workers 8 --worker-class gevent
+
+    # 滚动更新：重新导入view的代码，启动新的worker，旧的worker处理完请求后退出
+    kill -HUP <master pid>
+"""
+import argparse
+import importlib
+import multiprocessing
+import os
+import sys
+import traceback
+
+from gunicorn.app.base import BaseApplication
+
+from dn.common import log
+from dn.common.metrics import registry
+from dn.common.yamlconfig import YamlConfig
+
+logger = log.get_logger('server')
+
+# config.yaml中的worker_class与gunicorn的worker class对应关系
+WORKER_CLASSES = {
+    'sync': 'sync',
+    'threads': 'gthread',
+    'gthread': 'gthread',
+    'gevent': 'gevent',
+}
+
+
+def post_worker_init(worker):
+    # worker加载app之后提前启动进程池的子进程，第一个请求不需要等待
+    from dn.common.health import health
+    from dn.common.procpool import procpool
+    from dn.common.reload import reloader
+    from dn.common.shutdown import shutdown
+    procpool.server_workers = worker.cfg.workers
+    if procpool.preload:
+        procpool.warmup()
+    shutdown.install_worker(worker)
+    health.start()
+    reloader.master_pid = worker.ppid
+
+
+def worker_exit(server, worker):
+    # worker退出前等待请求和后台任务结束，然后关闭连接池。
+    # master清理已经退出的worker时也会调用，这时什么都不做
+    from dn.common.shutdown import shutdown
+    if worker.pid == os.getpid():
+        shutdown.drain()
+
+
+DEFAULT_OPTIONS = {
+    'bind': '0.0.0.0:8000',
+    'workers': multiprocessing.cpu_count() * 2 + 1,
+    'worker_class': 'sync',
+    'threads': 4,
+    'worker_connections': 1000,
+    'reuse_port': False,
+    'max_requests': 0,
+    'max_requests_jitter': 0,
+    'preload_app': True,
+    'timeout': 30,
+    'graceful_timeout': 30,
+    'keepalive': 2,
+    'post_worker_init': post_worker_init,
+    'worker_exit': worker_exit,
+}
+
+
+def server_options(conf=None, **overrides):
+    options = dict(DEFAULT_OPTIONS)
+    options.update(conf or {})
+    options.update((k, v) for k, v in overrides.items() if v is not None)
+    worker_class = options['worker_class']
+    if worker_class not in WORKER_CLASSES:
+        raise RuntimeError('unknown worker_class: %s' % worker_class)
+    options['worker_class'] = WORKER_CLASSES[worker_class]
+    if options['worker_class'] == 'sync':
+        # threads大于1时gunicorn会把sync worker换成gthread，threads只对threads生效
+        options['threads'] = 1
+    return options
+
+
+def load_wsgi_app(app_uri):
+    module_name, _, name = app_uri.partition(':')
+    module = importlib.import_module(module_name)
+    app = getattr(module, name or 'app')
+    return getattr(app, 'flaskapp', app)
+
+
+def reload_wsgi_app(app_uri):
+    """重新导入view所在的模块，再重新执行app所在的模块。"""
+    from dn.app import DNView
+    from dn.common.reload import reloader
+
+    module_name = app_uri.partition(':')[0]
+    reloader.reload(DNView.__subclasses__(), exclude=(module_name,))
+    module = sys.modules.get(module_name)
+    if module is not None:
+        # preload_app为False时master中还没有导入过
+        importlib.reload(module)
+    return load_wsgi_app(app_uri)
+
+
+class DNServer(BaseApplication):
+    """
+    loader为返回wsgi app的函数，preload_app为True时在master中调用一次，
+    fork出来的worker直接使用，否则每个worker各自调用。
+    reloader为master收到SIGHUP时重新加载代码的函数，返回新的wsgi app。
+    """
+
+    def __init__(self, loader, options, reloader=None):
+        self.loader = loader
+        self.reloader = reloader
+        self.options = options
+        super(DNServer, self).__init__()
+
+    def reload(self):
+        super(DNServer, self).reload()
+        if self.reloader is None:
+            return
+        try:
+            self.callable = self.reloader()
+        except Exception:
+            # 新的代码有错误时继续使用旧的app，新的worker与以前相同
+            logger.error('RELOAD_FAILED', traceback.format_exc())
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.loader()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='dn production server')
+    parser.add_argument('app', help='module:app, app is a DNApp or flask app')
+    parser.add_argument('-c', '--config', default='config.yaml')
+    parser.add_argument('-b', '--bind')
+    parser.add_argument('-w', '--workers', type=int)
+    parser.add_argument('-k', '--worker-class', choices=sorted(WORKER_CLASSES))
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--max-requests', type=int)
+    parser.add_argument('--reuse-port', action='store_true', default=None)
+    parser.add_argument('--preload', dest='preload_app',
+                        action='store_true', default=None)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    conf = {}
+    if os.path.exists(args.config):
+        yaml_config = YamlConfig(args.config)
+        conf = yaml_config.server
+        registry.configure(**yaml_config.metrics)
+        registry.reset_directory()
+    options = server_options(
+        conf, bind=args.bind, workers=args.workers,
+        worker_class=args.worker_class, threads=args.threads,
+        max_requests=args.max_requests, reuse_port=args.reuse_port,
+        preload_app=args.preload_app)
+    DNServer(lambda: load_wsgi_app(args.app), options,
+             reloader=lambda: reload_wsgi_app(args.app)).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,9 @@ install_requires = [
     'flask==1.0.2',
     'gevent==1.4.0',
     'gunicorn',
+    'PyYAML',
+    'redis',
+    'contextvars; python_version < "3.7"',
 ]
 
 setup(
@@ -15,4 +18,7 @@ setup(
     description='flask dn server',
     packages=find_packages(),
     zip_safe=False,
-    install_requires=install_requires,)
+    install_requires=install_requires,
+    entry_points={
+        'console_scripts': ['dn-serve = dn.server:main'],
+    },)